@@ -1,48 +1,469 @@
 from DbConnector import DbConnector
-from datetime import datetime
-import time
+from datetime import datetime, timedelta
+from haversine import haversine_vector
+from instrumentation import Instrumentation
+from labels import LabelIndex
+from ParseCache import PARSE_CACHE_PATH, ParseCache
+from plt import MAX_POINTS, read_records
+from simplify import SIMPLIFY_MODES, simplify
+from timestamps import decode_datetime, decode_datetimes
+from trackpoints import TrackPointColumns
+from collections import deque
+import argparse
+import hashlib
+import multiprocessing
+import queue
+import threading
 
+from pymongo import ReplaceOne, UpdateOne
+import bson
+import numpy as np
 import os
 
 DATASET_ROOT_PATH = "./dataset"
-DATASET_PATH = DATASET_ROOT_PATH + "/Data/"
-DATASET_LABELED_IDS = DATASET_ROOT_PATH + "/labeled_ids.txt"
 
-class DataUploader:
+DEFAULT_BATCH_SIZE = 10000
+
+# Pipelined ingest: batches waiting for a writer thread, the parser blocks when the queue is full
+DEFAULT_WRITERS = 4
+DEFAULT_QUEUE_SIZE = 8
+
+# Trackpoints are stored either as one document per point in TrackPoint ("documents"), or as chunks of
+# at most DEFAULT_BUCKET_SIZE points of one activity with one array per field in TrackPointBucket ("buckets"),
+# or as one document per point in the MongoDB time-series collection TrackPointSeries ("timeseries"), where
+# user_id and activity_id are in the meta field and the server groups the points into compressed buckets.
+# Points also get a GeoJSON location for the 2dsphere index and a grid cell and time bucket for the co-location
+# query (see trackpoints.py), buckets get the bounding box of their points.
+LAYOUT_DOCUMENTS = "documents"
+LAYOUT_BUCKETS = "buckets"
+LAYOUT_TIMESERIES = "timeseries"
+LAYOUTS = (LAYOUT_DOCUMENTS, LAYOUT_BUCKETS, LAYOUT_TIMESERIES)
+TRACKPOINT_COLLECTIONS = {LAYOUT_DOCUMENTS: "TrackPoint", LAYOUT_BUCKETS: "TrackPointBucket",
+                          LAYOUT_TIMESERIES: "TrackPointSeries"}
+TIMESERIES_OPTIONS = {"timeField": "date_time", "metaField": "meta", "granularity": "seconds"}
+BUCKET_FIELDS = ("lat", "lon", "altitude", "date_days", "date_time")
+DEFAULT_BUCKET_SIZE = 2500
+
+# altitude the plt files use for points without a valid altitude
+INVALID_ALTITUDE = -777
+
+# The incremental ingest records every plt and labels file it has loaded here, with the IDs it was given
+MANIFEST_COLLECTION = "IngestManifest"
+MANIFEST_COUNTERS = "__counters__"
+
+# Version stamp of the data, bumped whenever the data changes so that cached query results are invalidated
+META_COLLECTION = "Meta"
+DATASET_VERSION = "dataset_version"
+
+# Counters of the activities kept up to date by every upload, so that q2-q6 and q11 read a few small documents
+# instead of aggregating the Activity collection: activities per user, per transportation mode and per user and
+# mode, activities and recorded milliseconds per year of the start time. The SUMMARIES entry in META_COLLECTION
+# says whether they match the activities, an interrupted incremental run leaves them invalid until they are rebuilt.
+USER_SUMMARY = "UserSummary"
+MODE_SUMMARY = "ModeSummary"
+YEAR_SUMMARY = "YearSummary"
+USER_MODE_SUMMARY = "UserModeSummary"
+SUMMARY_COLLECTIONS = (USER_SUMMARY, MODE_SUMMARY, YEAR_SUMMARY, USER_MODE_SUMMARY)
+SUMMARIES = "summaries"
+SUMMARY_FIELDS = {"user_id": 1, "transportation_mode": 1, "start_date_time": 1, "end_date_time": 1}
+
+
+def make_buckets(trackpoints, bucket_size=DEFAULT_BUCKET_SIZE):
+    '''
+    Group trackpoints into bucket documents, one array per field and at most bucket_size points per bucket
+    :param trackpoints: TrackPointColumns ordered by _id, each with the points of one activity
+    :param bucket_size: maximum number of points in a bucket
+    :return: list of bucket documents, the _id of a bucket is the _id of its first trackpoint
+    '''
+    buckets = []
+
+    for columns in trackpoints:
+        for n, start in enumerate(range(0, len(columns), bucket_size)):
+            stop = min(start + bucket_size, len(columns))
+            date_times = columns.date_times(start, stop)
+            lat = columns.lat[start:stop]
+            lon = columns.lon[start:stop]
+            buckets.append({
+                "_id": columns.first_id + start,
+                "activity_id": columns.activity_id,
+                "user_id": columns.user_id,
+                "n": n,
+                "count": stop - start,
+                "start_date_time": min(date_times),
+                "end_date_time": max(date_times),
+                "min_lat": min(lat),
+                "max_lat": max(lat),
+                "min_lon": min(lon),
+                "max_lon": max(lon),
+                "lat": lat.tolist(),
+                "lon": lon.tolist(),
+                "altitude": columns.altitude[start:stop].tolist(),
+                "date_days": columns.date_days[start:stop].tolist(),
+                "date_time": date_times
+            })
+
+    return buckets
+
+
+def activity_metrics(trackpoints):
+    '''
+    Summarise the trackpoints of one activity so that queries do not have to read the points
+    :param trackpoints: TrackPointColumns of the activity in recorded order
+    :return: dict with point_count, distance (km, haversine), altitude_gain (feet, sum of the rises between
+        consecutive valid altitudes), max_time_gap (seconds between consecutive points) and the bounding box
+    '''
+    # one vectorised pass over the columns, the arrays are viewed in place
+    lat = np.frombuffer(trackpoints.lat, dtype=np.float64)
+    lon = np.frombuffer(trackpoints.lon, dtype=np.float64)
+    times = np.frombuffer(trackpoints.times, dtype=np.int64)
+    altitude = np.frombuffer(trackpoints.altitude, dtype=np.float64)
+
+    metrics = {"point_count": len(trackpoints), "distance": 0.0, "altitude_gain": 0.0, "max_time_gap": 0.0}
+    if len(trackpoints) > 1:
+        points = np.column_stack((lat, lon))
+        metrics["distance"] = float(haversine_vector(points[:-1], points[1:]).sum())
+        metrics["max_time_gap"] = max(0.0, float(np.diff(times).max()) / 1e6)
+
+    rises = np.diff(altitude[altitude != INVALID_ALTITUDE])
+    metrics["altitude_gain"] = float(rises[rises > 0].sum())
+
+    if len(trackpoints) > 0:
+        metrics["min_lat"] = float(lat.min())
+        metrics["max_lat"] = float(lat.max())
+        metrics["min_lon"] = float(lon.min())
+        metrics["max_lon"] = float(lon.max())
+    return metrics
+
+
+def parse_user(user_dir, instrumented=False, **settings):
+    '''
+    Parse all trajectories for a single user in a worker process.
+    Activity and trackpoint IDs start at 1 and are shifted to their global values by DataUploader.shift_ids
+    :param user_dir: (user_id, root, plt_files, label_file) as given by DataUploader.iter_user_dirs
+    :param instrumented: record spans in the worker
+    :param settings: parse settings of the DataUploader, see DataUploader.parse_settings
+    :return: activities, activities_for_user and trackpoints for the user, and the spans of the worker
+    '''
+    user_id, root, files, label_file = user_dir
+    parser = DataUploader(connect=False, instrumentation=Instrumentation(instrumented), **settings)
+    trackpoints, activities, activities_for_user = parser.get_trackpoints_and_activites(root, files, label_file, user_id)
+    return activities, activities_for_user, trackpoints, parser.instrumentation.snapshot()["spans"]
+
+
+class BatchBuffer:
+    '''
+    Collects documents for a single collection and writes them in fixed-size batches,
+    so that at most one batch per collection is held in memory at a time
+    '''
+
+    def __init__(self, uploader, collection, max_docs=DEFAULT_BATCH_SIZE, max_bytes=None, write=None):
+        '''
+        :param uploader: DataUploader used for the inserts
+        :param collection: name of the collection the documents are written to
+        :param max_docs: flush when this many documents are buffered (None for no limit)
+        :param max_bytes: flush when the BSON size of the buffered documents reaches this (None for no limit)
+        :param write: function(collection, documents) taking a full batch, by default uploader.insert_data_many
+        '''
+        self.uploader = uploader
+        self.collection = collection
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.write = write or uploader.insert_data_many
+
+        self.documents = []
+        self.size = 0
+        self.inserted = 0
+        self.batches = 0
+
+    def add(self, documents):
+        '''
+        Add documents to the buffer, flushing whenever a batch is full
+        :param documents: iterable of documents
+        '''
+        for document in documents:
+            self.documents.append(document)
+            if self.max_bytes is not None:
+                self.size += len(bson.encode(document))
+
+            if (self.max_docs is not None and len(self.documents) >= self.max_docs) or \
+                    (self.max_bytes is not None and self.size >= self.max_bytes):
+                self.flush()
+
+    def flush(self):
+        '''
+        Write the buffered documents to the database
+        '''
+        if len(self.documents) == 0:
+            return
+
+        self.write(self.collection, self.documents)
+        self.inserted += len(self.documents)
+        self.batches += 1
+
+        self.documents = []
+        self.size = 0
+
+
+class SummaryCounters:
+    '''
+    Changes to the summary collections, collected in memory and written as one $inc upsert per summary document
+    '''
 
     def __init__(self):
-        self.connection = DbConnector()
-        self.client = self.connection.client
-        self.db = self.connection.db
+        self.counters = {collection: {} for collection in SUMMARY_COLLECTIONS}
+
+    def add(self, activities, sign=1):
+        '''
+        Count activities, or uncount them with sign -1
+        :param activities: activity documents with at least the fields in SUMMARY_FIELDS
+        '''
+        for activity in activities:
+            user_id = activity["user_id"]
+            mode = activity["transportation_mode"]
+            start = activity["start_date_time"]
+            duration = (activity["end_date_time"] - start) // timedelta(milliseconds=1)
+
+            self.count(USER_SUMMARY, user_id, sign)
+            self.count(MODE_SUMMARY, mode, sign)
+            self.count(YEAR_SUMMARY, start.year, sign, duration)
+            self.count(USER_MODE_SUMMARY, (user_id, mode), sign)
+
+    def count(self, collection, key, sign, duration=0):
+        counter = self.counters[collection].setdefault(key, [0, 0])
+        counter[0] += sign
+        counter[1] += sign * duration
+
+    def write(self, db):
+        '''
+        Apply the changes to the summary collections and delete the summary documents that reach zero activities
+        '''
+        for collection, counters in self.counters.items():
+            requests = []
+            for key, (activities, duration) in counters.items():
+                if activities == 0 and duration == 0:
+                    continue
+                increments = {"activities": activities}
+                if collection == YEAR_SUMMARY:
+                    increments["duration"] = duration
+                if collection == USER_MODE_SUMMARY:
+                    key = {"user_id": key[0], "transportation_mode": key[1]}
+                requests.append(UpdateOne({"_id": key}, {"$inc": increments}, upsert=True))
+
+            if len(requests) > 0:
+                db[collection].bulk_write(requests, ordered=False)
+                if any(activities < 0 for activities, _ in counters.values()):
+                    db[collection].delete_many({"activities": {"$lte": 0}})
+            counters.clear()
+
+
+class WriteQueue:
+    '''
+    Bounded queue of batches drained by writer threads, so that parsing continues while batches are written.
+    put blocks while the queue is full, which bounds the memory to max_batches queued batches plus the one
+    batch every writer is inserting.
+    '''
+
+    def __init__(self, uploader, writers=DEFAULT_WRITERS, max_batches=DEFAULT_QUEUE_SIZE):
+        '''
+        :param uploader: DataUploader used for the inserts, its MongoClient is shared by the writer threads
+        :param writers: number of writer threads
+        :param max_batches: number of batches that can wait in the queue
+        '''
+        self.uploader = uploader
+        self.queue = queue.Queue(max_batches)
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self.drain, name="writer-%s" % i, daemon=True)
+                        for i in range(writers)]
+
+        self.documents = 0
+        self.batches = 0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, collection, documents):
+        '''
+        Queue a batch for the writers, waiting while the queue is full (the span queue.wait)
+        '''
+        with self.uploader.instrumentation.span("queue.wait", batches=1):
+            self.queue.put((collection, documents))
+
+    def drain(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            collection, documents = batch
+            self.uploader.insert_data_many(collection, documents)
+            with self.lock:
+                self.documents += len(documents)
+                self.batches += 1
+
+    def close(self):
+        '''
+        Wait until all queued batches are written and stop the writers
+        '''
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class DataUploader:
+
+    def __init__(self, connect=True, label_overlap=None, layout=LAYOUT_DOCUMENTS, bucket_size=DEFAULT_BUCKET_SIZE,
+                 connection=None, dataset_root=DATASET_ROOT_PATH, instrumentation=None, raw_bson=True,
+                 max_points=MAX_POINTS, parse_cache=None, simplify_tolerance=None, simplify_mode="spatial"):
+        '''
+        :param connect: connect to the database, parsing works without a connection
+        :param label_overlap: also match trajectories to labels that overlap them by at least this fraction
+            (intersection over union), None only matches labels with the exact same start and end time
+        :param layout: how trackpoints are stored, one of LAYOUTS
+        :param bucket_size: maximum number of points in a bucket for the "buckets" layout
+        :param connection: DbConnector to use, by default a connector with the "ingest" profile
+        :param dataset_root: folder with labeled_ids.txt and the Data folder of the Geolife dataset
+        :param instrumentation: Instrumentation recording the stages and database commands of the ingest
+        :param raw_bson: write trackpoint documents as BSON packed by TrackPointColumns.raw_documents
+            instead of dicts encoded by pymongo
+        :param max_points: plt files with more points than this are excluded
+        :param parse_cache: ParseCache to load parsed users from and store them in, None to always parse the files
+        :param simplify_tolerance: drop the trackpoints within this many metres of the trajectory simplified with
+            Douglas-Peucker (see simplify.py), None to keep every point. Activity metrics use all points
+        :param simplify_mode: one of SIMPLIFY_MODES
+        '''
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown trackpoint layout: " + str(layout))
+        if simplify_mode not in SIMPLIFY_MODES:
+            raise ValueError("Unknown simplification mode: " + str(simplify_mode))
+        self.instrumentation = instrumentation or Instrumentation()
+        if connect:
+            self.connection = connection or DbConnector(profile="ingest",
+                                                        event_listeners=self.instrumentation.event_listeners())
+            self.client = self.connection.client
+            self.db = self.connection.db
+
+        self.dataset_path = os.path.join(dataset_root, "Data")
+        self.labeled_ids_path = os.path.join(dataset_root, "labeled_ids.txt")
+        self.label_overlap = label_overlap
+        self.layout = layout
+        self.bucket_size = bucket_size
+        self.trackpoint_collection = TRACKPOINT_COLLECTIONS[layout]
+        self.raw_bson = raw_bson
+        self.max_points = max_points
+        self.parse_cache = parse_cache
+        self.simplify_tolerance = simplify_tolerance
+        self.simplify_mode = simplify_mode
 
         self.ACTIVITY_ID = 1
         self.TRACKPOINT_ID = 1
 
-    def create_collections(self):
+        # inserts that failed, also in the writer threads, the summaries are only marked valid when there were none
+        self.failed_inserts = 0
+        self.failed_lock = threading.Lock()
+
+    def create_collections(self, existing_ok=False):
         '''
         Create collections in database
+        :param existing_ok: only create the collections that do not exist yet
+        '''
+        existing = self.db.list_collection_names() if existing_ok else []
+        created = []
+        for name in ('User', 'Activity', self.trackpoint_collection):
+            if name not in existing:
+                if name == TRACKPOINT_COLLECTIONS[LAYOUT_TIMESERIES]:
+                    created.append(self.db.create_collection(name, timeseries=TIMESERIES_OPTIONS))
+                else:
+                    created.append(self.db.create_collection(name))
+        print('Created collections: ', tuple(created))
+
+    def trackpoint_documents(self, trackpoints):
+        '''
+        Turn parsed trackpoints into the documents stored for the layout
+        :param trackpoints: TrackPointColumns ordered by _id
+        :return: documents for self.trackpoint_collection, point documents are built lazily while they are written
         '''
-        user_collection = self.db.create_collection('User')
-        activity_collection = self.db.create_collection('Activity')
-        trackpoint_collection = self.db.create_collection('TrackPoint')
-        print('Created collections: ', (user_collection, activity_collection, trackpoint_collection))
+        if self.layout == LAYOUT_BUCKETS:
+            return make_buckets(trackpoints, self.bucket_size)
+        meta = self.layout == LAYOUT_TIMESERIES
+        if self.raw_bson:
+            return (document for columns in trackpoints for document in columns.raw_documents(meta))
+        return (document for columns in trackpoints for document in columns.documents(meta))
 
     def insert_data_many(self, collection, data):
         '''
         Method for inserting many documents into a collection
         '''
+        # counted while pymongo consumes them, inserted_ids leaves out RawBSONDocuments
+        inserted = 0
+
+        def counted():
+            nonlocal inserted
+            for document in data:
+                inserted += 1
+                yield document
 
         try:
-            self.db[collection].insert_many(data, False)
+            with self.instrumentation.span("insert." + collection, batches=1) as span:
+                self.db[collection].insert_many(counted() if self.instrumentation.enabled else data, False)
+                span.add(documents=inserted)
         except Exception as e:
-            print("Not able to insert data into collection " + collection + e)
+            print("Not able to insert data into collection " + collection + ": " + str(e))
+            with self.failed_lock:
+                self.failed_inserts += 1
+
+    def bump_dataset_version(self):
+        '''
+        Mark the data as changed, see QueryCache
+        '''
+        self.db[META_COLLECTION].update_one({"_id": DATASET_VERSION}, {"$inc": {"version": 1}}, upsert=True)
+
+    def summaries_valid(self):
+        '''
+        :return: True when the summary collections match the Activity collection
+        '''
+        state = self.db[META_COLLECTION].find_one({"_id": SUMMARIES})
+        return state is not None and state.get("valid", False)
+
+    def set_summaries_valid(self, valid):
+        self.db[META_COLLECTION].update_one({"_id": SUMMARIES}, {"$set": {"valid": valid}}, upsert=True)
+
+    def write_summaries(self, summaries):
+        '''
+        Apply counted activities to the summary collections, which then match the Activity collection
+        :param summaries: SummaryCounters
+        '''
+        with self.instrumentation.span("summaries", batches=1):
+            summaries.write(self.db)
+        self.set_summaries_valid(True)
+
+    def rebuild_summaries(self):
+        '''
+        Count the summary collections again from the Activity collection
+        '''
+        print("Rebuilding the summary collections")
+        summaries = SummaryCounters()
+        summaries.add(self.db['Activity'].find({}, SUMMARY_FIELDS))
+        # emptied rather than dropped, which would also drop their indexes
+        for collection in SUMMARY_COLLECTIONS:
+            self.db[collection].delete_many({})
+        self.write_summaries(summaries)
+
+    def upsert_data_many(self, collection, data):
+        '''
+        Method for inserting or replacing many documents by _id, so that writing the same documents again is harmless
+        '''
+        requests = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) for document in data]
+        if len(requests) > 0:
+            with self.instrumentation.span("upsert." + collection, documents=len(requests), batches=1):
+                self.db[collection].bulk_write(requests, ordered=False)
 
     def get_labeled_ids(self):
         '''
         Read the file with users that has labeled data
         @return: users with labeled ids
         '''
-        with open(DATASET_LABELED_IDS) as file:
+        with open(self.labeled_ids_path) as file:
             ids = file.readlines()
             ids = [id.strip() for id in ids]
             return ids
@@ -53,62 +474,75 @@ class DataUploader:
         @param date_text: date string
         @return: date python object
         '''
-        date_text = date_text.replace('/', '-')
-        return datetime.strptime(date_text, '%Y-%m-%d %H:%M:%S')
+        return decode_datetime(date_text)
 
-    def get_trackpoints_and_activites(self, root, plt_files, label_file, user_id):
+    def get_labels(self, label_file):
         '''
-        Get trackpoints and activies for a single user, match labeled activities to an activity derived from the trackpoints
-        :param root: root path for directory
-        :param plt_files: filename for plt file with trajectory data for an activity
+        Read the labeled activities for a user
         :param label_file: file directory and name for file with labeled activies with transport mode
-        :param user_id: user id for the specific trajectories
-        :return: trackpoints and activities for a user
+        :return: list of [start_time, end_time, transportation_mode]
         '''
-
         activities_with_labels = []
-        activities = []
-        activities_for_user = []
-        trackpoints = []
 
         if label_file != "":
-            with open(label_file) as file:
+            with self.instrumentation.span("labels", files=1) as span, open(label_file) as file:
                     records = file.readlines()[1:]
                     for record in records:
                         items = [item.strip() for item in record.split('\t')]
                         items[0] = self.read_datetime(items[0])
                         items[1] = self.read_datetime(items[1])
                         activities_with_labels.append(items)
+                    span.add(labels=len(activities_with_labels))
+
+        return activities_with_labels
+
+    def iter_activities(self, root, plt_files, labels, user_id):
+        '''
+        Parse the plt files for a single user one file at a time, match labeled activities to an activity derived from the trackpoints
+        :param root: root path for directory
+        :param plt_files: filenames for plt files with trajectory data for an activity
+        :param labels: LabelIndex with the labeled activities for the user
+        :param user_id: user id for the specific trajectories
+        :return: generator of (activities, activities_for_user, trackpoints) for every plt file that is not excluded,
+            trackpoints is a list with the TrackPointColumns of the file
+        '''
 
         for file_path in plt_files:
-            activity_added_with_label = False
+            activities = []
+            activities_for_user = []
             start_time, end_time, single_trackpoints = self.get_trackpoints(root + "/" + file_path, user_id)
             if single_trackpoints is not None:
-                if len(activities_with_labels) > 0:
-                    for activity in activities_with_labels:
-                        if activity[0] == start_time and activity[1] == end_time:
-                            activities.append({
-                                "_id": self.ACTIVITY_ID,
-                                "user_id": user_id,
-                                "transportation_mode": activity[2],
-                                "start_date_time": start_time,
-                                "end_date_time": end_time
-                            })
+                metrics = activity_metrics(single_trackpoints)
+                if self.simplify_tolerance is not None:
+                    single_trackpoints = self.simplify_trackpoints(single_trackpoints, metrics)
+                modes = labels.match(start_time, end_time, self.label_overlap) if len(labels) > 0 else []
+                for i, mode in enumerate(modes):
+                    # the trackpoints belong to the first activity of the file, so only that one gets their metrics
+                    if i == 1:
+                        metrics = activity_metrics(TrackPointColumns())
+                    activities.append({
+                        "_id": self.ACTIVITY_ID,
+                        "user_id": user_id,
+                        "transportation_mode": mode,
+                        "start_date_time": start_time,
+                        "end_date_time": end_time,
+                        **metrics
+                    })
 
-                            activities_for_user.append({
-                                "id": self.ACTIVITY_ID,
-                                "transportation_mode": activity[2]
-                            })
+                    activities_for_user.append({
+                        "id": self.ACTIVITY_ID,
+                        "transportation_mode": mode
+                    })
 
-                            self.ACTIVITY_ID += 1
-                            activity_added_with_label = True
-                if activity_added_with_label is False:
+                    self.ACTIVITY_ID += 1
+                if len(modes) == 0:
                     activities.append({
                                 "_id": self.ACTIVITY_ID,
                                 "user_id": user_id,
                                 "transportation_mode": "null",
                                 "start_date_time": start_time,
-                                "end_date_time": end_time
+                                "end_date_time": end_time,
+                                **metrics
                             })
 
                     activities_for_user.append({
@@ -118,7 +552,74 @@ class DataUploader:
 
                     self.ACTIVITY_ID += 1
 
-                trackpoints.extend(single_trackpoints)
+                yield activities, activities_for_user, [single_trackpoints]
+
+    def simplify_trackpoints(self, trackpoints, metrics):
+        '''
+        Simplify the trackpoints of a file and give the kept points consecutive IDs
+        :param trackpoints: TrackPointColumns of the file
+        :param metrics: activity_metrics of all the points, compared with those of the kept points in the span
+        :return: TrackPointColumns with the kept points
+        '''
+        with self.instrumentation.span("simplify", files=1) as span:
+            simplified = simplify(trackpoints, self.simplify_tolerance, self.simplify_mode)
+            kept_metrics = activity_metrics(simplified)
+            span.add(points=len(trackpoints), kept=len(simplified), distance=metrics["distance"],
+                     kept_distance=kept_metrics["distance"], altitude_gain=metrics["altitude_gain"],
+                     kept_altitude_gain=kept_metrics["altitude_gain"])
+        self.TRACKPOINT_ID = simplified.first_id + len(simplified)
+        return simplified
+
+    def report_simplification(self):
+        '''
+        Print how much the simplification reduced the trackpoints and their distance and altitude gain,
+        including the users loaded from the parse cache with the counters recorded when they were parsed
+        '''
+        spans = self.instrumentation.snapshot()["spans"]
+        if "simplify" not in spans and "simplify.cached" not in spans:
+            return
+        counters = {"files": 0, "points": 0, "kept": 0, "distance": 0, "kept_distance": 0, "altitude_gain": 0,
+                    "kept_altitude_gain": 0}
+        for name in ("simplify", "simplify.cached"):
+            for counter, value in spans.get(name, {"counters": {}})["counters"].items():
+                if counter in counters:
+                    counters[counter] += value
+
+        def change(kept, total):
+            return 100.0 * (kept - total) / total if total else 0.0
+
+        print("Simplified %s files with a tolerance of %s m (%s): kept %s of %s trackpoints (%.1f%%), "
+              "distance %+.2f%%, altitude gain %+.2f%%"
+              % (counters["files"], self.simplify_tolerance, self.simplify_mode, counters["kept"], counters["points"],
+                 100.0 * counters["kept"] / max(counters["points"], 1),
+                 change(counters["kept_distance"], counters["distance"]),
+                 change(counters["kept_altitude_gain"], counters["altitude_gain"])))
+        cached = spans.get("simplify.cached", {"counters": {}})["counters"]
+        if cached.get("uncounted", 0) > 0:
+            print("Not included: %s users loaded from the parse cache without simplification counters"
+                  % cached["uncounted"])
+
+    def get_trackpoints_and_activites(self, root, plt_files, label_file, user_id):
+        '''
+        Get trackpoints and activies for a single user, match labeled activities to an activity derived from the trackpoints
+        :param root: root path for directory
+        :param plt_files: filename for plt file with trajectory data for an activity
+        :param label_file: file directory and name for file with labeled activies with transport mode
+        :param user_id: user id for the specific trajectories
+        :return: trackpoints (list of TrackPointColumns) and activities for a user
+        '''
+
+        activities = []
+        activities_for_user = []
+        trackpoints = []
+
+        labels = LabelIndex(self.get_labels(label_file))
+
+        for activities_single, activities_for_user_single, single_trackpoints in \
+                self.iter_activities(root, plt_files, labels, user_id):
+            activities.extend(activities_single)
+            activities_for_user.extend(activities_for_user_single)
+            trackpoints.extend(single_trackpoints)
 
         return trackpoints, activities, activities_for_user
 
@@ -127,116 +628,529 @@ class DataUploader:
         '''
         Get specific trackpoints for a plt file
         :param file_path: file path for the plt file
-        :return: start and end time of trajectory + trackpoints data structured for database injection
+        :return: start and end time of trajectory + TrackPointColumns with the trackpoints
         '''
 
-        # if file size is bigger than this, it has more than 2500 lines and is excluded.
-        file_stats = os.stat(file_path)
-        if file_stats.st_size > 204500:
+        with self.instrumentation.span("parse", files=1) as span:
+            start_time, end_time, trackpoints = self.read_trackpoints(file_path, user_id)
+            if trackpoints is None:
+                span.add(skipped=1)
+            elif self.instrumentation.enabled:
+                # a stat call per file, only made when the spans are recorded
+                span.add(points=len(trackpoints), bytes=os.path.getsize(file_path))
+        return start_time, end_time, trackpoints
+
+    def read_trackpoints(self, file_path, user_id):
+        '''
+        Read the trackpoints of a plt file, see get_trackpoints
+        '''
+
+        # files with more than max_points points are excluded
+        rows = read_records(file_path, self.max_points)
+        if rows is None:
             return None, None, None
 
         start_time = datetime(2200, 1, 1, 00, 00, 00)
         end_time = datetime(1900, 1, 1, 00, 00, 00)
 
-        trackpoints = []
+        times = decode_datetimes([items[4].decode() for items in rows], [items[5].decode() for items in rows])
 
-        with open(file_path) as file:
-            records = file.readlines()[6:]
+        if len(times) > 0:
+            start_time = min(times)
+            end_time = max(times)
 
-            if len(records) > 2500:
-                return None, None, None
+        trackpoints = TrackPointColumns(user_id, self.ACTIVITY_ID, self.TRACKPOINT_ID)
+        trackpoints.extend([float(items[0]) for items in rows], [float(items[1]) for items in rows],
+                           [float(items[2]) for items in rows], [float(items[3]) for items in rows], times)
+        self.TRACKPOINT_ID += len(trackpoints)
 
-            for record in records:
-                items = record.strip().split(',')
-                time = self.read_datetime((items[5] + ' ' + items[6]))
+        return start_time, end_time, trackpoints
 
-                if time < start_time:
-                    start_time = time
+    def iter_user_dirs(self):
+        '''
+        Walk the dataset and find the trajectory folder of every user
+        :return: generator of (user_id, root, plt_files, label_file) in the order of os.walk
+        '''
+        labeled_ids = self.get_labeled_ids()
 
-                if time > end_time:
-                    end_time = time
+        walk = os.walk(self.dataset_path, topdown=True)
+        while True:
+            with self.instrumentation.span("walk", dirs=1):
+                entry = next(walk, None)
+            if entry is None:
+                break
+            root, dirs, files = entry
+            path_parts = os.path.relpath(root, self.dataset_path).split(os.sep)
+            label_file = ""
+            if path_parts[0] in (".", ""): # make sure to be inside user folder
+                continue
+            user_id = path_parts[0]
 
-                trackpoints.append({
-                    "_id": self.TRACKPOINT_ID,
-                    "activity_id": self.ACTIVITY_ID,
-                    "user_id": user_id,
-                    "lat": float(items[0]),
-                    "lon": float(items[1]),
-                    "altitude": float(items[3]),
-                    "date_days": float(items[4]),
-                    "date_time": time
-                })
+            label_path = os.path.join(self.dataset_path, user_id, "labels.txt")
+            if user_id in labeled_ids and os.path.isfile(label_path):
+                label_file = label_path
 
-                self.TRACKPOINT_ID += 1
+            if "Trajectory" in path_parts[1:]:
+                files.sort()
+                yield user_id, root, files, label_file
 
-        return start_time, end_time, trackpoints
+    def shift_ids(self, activities, activities_for_user, trackpoints):
+        '''
+        Move activities and trackpoints parsed with IDs starting at 1 to the next free global IDs,
+        giving the same IDs as parsing them in this process would
+        '''
+        activity_offset = self.ACTIVITY_ID - 1
+        trackpoint_offset = self.TRACKPOINT_ID - 1
+
+        for activity in activities:
+            activity["_id"] += activity_offset
+
+        for activity in activities_for_user:
+            activity["id"] += activity_offset
+
+        for columns in trackpoints:
+            columns.first_id += trackpoint_offset
+            columns.activity_id += activity_offset
+
+        self.ACTIVITY_ID += len(activities)
+        self.TRACKPOINT_ID += sum(len(columns) for columns in trackpoints)
 
-    def upload_data(self):
+        return activities, activities_for_user, trackpoints
+
+    def iter_users(self, workers=None):
         '''
-        Get the data from the files and upload it to the database
+        Parse the dataset user by user, in this process or spread over a pool of worker processes.
+        Users are returned in the order of os.walk, so IDs are the same for any number of workers.
+        Users in the parse cache are loaded from it instead of parsed.
+        :param workers: number of worker processes, None or 1 to parse in this process
+        :return: generator of (user_id, label_file, parsed) where parsed yields (activities, activities_for_user, trackpoints)
         '''
+        if workers is None or workers <= 1:
+            for user_dir in self.iter_user_dirs():
+                user_id, root, files, label_file = user_dir
+                if self.parse_cache is None:
+                    labels = LabelIndex(self.get_labels(label_file))
+                    yield user_id, label_file, self.iter_activities(root, files, labels, user_id)
+                    continue
 
-        start_time = time.time()
+                cached = self.load_cached_user(user_dir)
+                if cached is None:
+                    result = parse_user(user_dir, self.instrumentation.enabled, **self.parse_settings())
+                    yield user_id, label_file, [self.parsed_in_worker(result, user_dir)]
+                else:
+                    yield user_id, label_file, [self.shift_ids(*cached)]
+            return
 
-        labeled_ids = self.get_labeled_ids()
+        # keep a bounded number of users in flight so finished users do not pile up in memory
+        with multiprocessing.Pool(workers) as pool:
+            pending = deque()
+            for user_dir in self.iter_user_dirs():
+                cached = self.load_cached_user(user_dir) if self.parse_cache is not None else None
+                result = None
+                if cached is None:
+                    result = pool.apply_async(parse_user, (user_dir, self.instrumentation.enabled),
+                                              self.parse_settings())
+                pending.append((user_dir, cached, result))
+                if len(pending) >= 2 * workers:
+                    yield self.take_pending(*pending.popleft())
 
-        users = []
-        users_ids = []
+            while pending:
+                yield self.take_pending(*pending.popleft())
 
-        activites = []
-        trackpoints = []
+    def take_pending(self, user_dir, cached, result):
+        '''
+        Take the next user in order from the users in flight in iter_users, IDs are only shifted here
+        :param cached: the user loaded from the parse cache, None when it is parsed by a worker
+        :param result: AsyncResult of parse_user, None when the user was cached
+        :return: (user_id, label_file, parsed) as iter_users yields it
+        '''
+        if cached is None:
+            return user_dir[0], user_dir[3], [self.parsed_in_worker(result.get(), user_dir)]
+        return user_dir[0], user_dir[3], [self.shift_ids(*cached)]
 
-        for root, dirs, files in os.walk(DATASET_PATH, topdown=True):
-            path_parts = root.split('/')
-            label_file = ""
-            if len(path_parts) < 4: # make sure to be inside user folder
-                continue
-            user_id = path_parts[3]
+    def parse_settings(self):
+        '''
+        :return: the settings that change the result of parse_user, see ParseCache
+        '''
+        return {"label_overlap": self.label_overlap, "max_points": self.max_points,
+                "simplify_tolerance": self.simplify_tolerance, "simplify_mode": self.simplify_mode}
+
+    def load_cached_user(self, user_dir):
+        '''
+        Load a user from the parse cache
+        :return: (activities, activities_for_user, trackpoints) with IDs starting at 1, None if the user is not cached
+        '''
+        with self.instrumentation.span("parse_cache.load") as span:
+            parsed = self.parse_cache.load(user_dir, self.parse_settings())
+            if parsed is None:
+                return None
+            span.add(users=1, points=sum(len(columns) for columns in parsed[2]))
 
-            print("\nGetting user data...")
-            if user_id not in users_ids and user_id != "":
-                users_ids.append(user_id)
+        activities, activities_for_user, trackpoints, simplify_counters = parsed
+        if self.simplify_tolerance is not None:
+            # the simplification of the user as recorded when it was parsed, see report_simplification
+            if simplify_counters is None:
+                self.instrumentation.record("simplify.cached", 0.0, users=1, uncounted=1)
+            else:
+                self.instrumentation.record("simplify.cached", 0.0, users=1, **simplify_counters)
+        return activities, activities_for_user, trackpoints
 
-            if user_id in labeled_ids:
-                label_file = DATASET_PATH + user_id + "/labels.txt"
+    def parsed_in_worker(self, result, user_dir):
+        '''
+        Take over the result of parse_user: store it in the parse cache, shift its IDs and add the spans of the worker
+        '''
+        activities, activities_for_user, trackpoints, spans = result
+        if self.parse_cache is not None:
+            # stored with the user for report_simplification, None when the worker recorded no spans
+            simplify_counters = None
+            if self.instrumentation.enabled:
+                simplify_counters = spans["simplify"]["counters"] if "simplify" in spans else {}
+            with self.instrumentation.span("parse_cache.store", users=1):
+                self.parse_cache.store(user_dir, self.parse_settings(),
+                                       (activities, activities_for_user, trackpoints, simplify_counters))
+        self.instrumentation.merge(spans)
+        return self.shift_ids(activities, activities_for_user, trackpoints)
 
+    def upload_data(self, workers=None):
+        '''
+        Get the data from the files and upload it to the database
+        :param workers: number of processes used to parse the files
+        '''
 
-            if "Trajectory" in root:
-                files.sort()
+        users, activites, trackpoints = self.read_data(workers)
 
-                print("Getting activites and trackpoints for user: " + user_id)
-                if label_file != "":
-                    trackpoints_single, activities_single, activities_for_user = self.get_trackpoints_and_activites(root, files, label_file, user_id)
-                else:
-                    trackpoints_single, activities_single, activities_for_user = self.get_trackpoints_and_activites(root, files, "", user_id)
+        print("Inserting data into Users")
+        self.insert_data_many("User", users)
+
+        print("Inserting data into Activity")
+        self.insert_data_many("Activity", activites)
+
+        print("Inserting data into " + self.trackpoint_collection)
+        self.insert_data_many(self.trackpoint_collection, self.trackpoint_documents(trackpoints))
+
+        summaries = SummaryCounters()
+        summaries.add(activites)
+        self.finish_upload(summaries)
+        self.report_simplification()
+        self.instrumentation.report()
+
+    def finish_upload(self, summaries):
+        '''
+        Write the summaries of a complete upload and bump the dataset version, only when every insert succeeded.
+        Otherwise the summaries stay invalid, so the queries aggregate the Activity collection instead
+        :param summaries: SummaryCounters of all uploaded activities
+        :return: True when the upload was complete
+        '''
+        if self.failed_inserts > 0:
+            print("%s inserts failed, the summary collections are left invalid: upload the data again"
+                  % self.failed_inserts)
+            return False
+        self.write_summaries(summaries)
+        self.bump_dataset_version()
+        return True
+
+    def read_data(self, workers=None):
+        '''
+        Get all the data from the files
+        :param workers: number of processes used to parse the files
+        :return: user documents, activity documents and the TrackPointColumns of all files
+        '''
+
+        users = []
+
+        activites = []
+        trackpoints = []
 
-                users.append({"_id": user_id, "has_labels": user_id in labeled_ids, "activities": activities_for_user})
+        for user_id, label_file, parsed in self.iter_users(workers):
+            print("Getting activites and trackpoints for user: " + user_id)
+            activities_for_user = []
 
+            for activities_single, activities_for_user_single, trackpoints_single in parsed:
                 activites.extend(activities_single)
+                activities_for_user.extend(activities_for_user_single)
                 trackpoints.extend(trackpoints_single)
 
+            users.append({"_id": user_id, "has_labels": label_file != "", "activities": activities_for_user})
+
         print("Trackpoint ID: " + str(self.TRACKPOINT_ID))
-        print("Number of trackpoints: " + str(len(trackpoints)))
+        print("Number of trackpoints: " + str(sum(len(columns) for columns in trackpoints)))
 
         print("READ ALL FILES")
+        return users, activites, trackpoints
 
-        time_to_read = time.time()
-        print("Time to read files: --- %s seconds ---" % (time_to_read - start_time))
+    def upload_data_streaming(self, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=None, workers=None, writers=None,
+                              queue_size=DEFAULT_QUEUE_SIZE):
+        '''
+        Get the data from the files and upload it to the database in fixed-size batches while the files are parsed.
+        Only the current plt file (the users in flight when using workers) and one batch per collection is held in memory.
+        :param batch_size: maximum number of documents per insert (None for no limit)
+        :param batch_bytes: maximum BSON size in bytes per insert (None for no limit)
+        :param workers: number of processes used to parse the files
+        :param writers: number of threads inserting the batches through a WriteQueue while parsing continues,
+            None to insert every batch before parsing on
+        :param queue_size: number of full batches that can wait for a writer
+        '''
 
-        print("Inserting data into Users")
-        self.insert_data_many("User", users)
-        time_to_upload_users = time.time()
-        print("Time to insert Users: --- %s seconds ---" % (time_to_upload_users - time_to_read))
+        write_queue = None
+        write = None
+        if writers:
+            write_queue = WriteQueue(self, writers, queue_size)
+            write_queue.start()
+            write = write_queue.put
 
-        print("Inserting data into Activity")
-        self.insert_data_many("Activity", activites)
-        time_to_upload_activities = time.time()
-        print("Time to insert Activities: --- %s seconds ---" % (time_to_upload_activities - time_to_upload_users))
+        users = BatchBuffer(self, "User", batch_size, batch_bytes, write)
+        activities = BatchBuffer(self, "Activity", batch_size, batch_bytes, write)
+        trackpoints = BatchBuffer(self, self.trackpoint_collection, batch_size, batch_bytes, write)
+        summaries = SummaryCounters()
+        points = 0
+
+        with self.instrumentation.span("upload.streaming"):
+            try:
+                with self.instrumentation.span("upload.parse") as parse_span:
+                    for user_id, label_file, parsed in self.iter_users(workers):
+                        print("Getting activites and trackpoints for user: " + user_id)
+                        activities_for_user = []
 
-        print("Inserting data into TrackPoints")
-        self.insert_data_many("TrackPoint", trackpoints)
-        time_to_upload_tp = time.time()
-        print("Time to insert TrackPoints: --- %s seconds ---" % (time_to_upload_tp - time_to_upload_activities))
+                        for activities_single, activities_for_user_single, trackpoints_single in parsed:
+                            activities.add(activities_single)
+                            trackpoints.add(self.trackpoint_documents(trackpoints_single))
+                            activities_for_user.extend(activities_for_user_single)
+                            summaries.add(activities_single)
+                            points += sum(len(columns) for columns in trackpoints_single)
+
+                        users.add([{"_id": user_id, "has_labels": label_file != "", "activities": activities_for_user}])
+
+                    for buffer in (users, activities, trackpoints):
+                        buffer.flush()
+                    parse_span.add(points=points)
+            finally:
+                if write_queue is not None:
+                    # the writes still queued when parsing finished
+                    with self.instrumentation.span("upload.drain"):
+                        write_queue.close()
+
+            for buffer in (users, activities, trackpoints):
+                print("Inserted %s documents into %s in %s batches"
+                      % (buffer.inserted, buffer.collection, buffer.batches))
+
+            self.finish_upload(summaries)
+
+        if write_queue is not None:
+            self.report_pipeline(write_queue)
+        self.report_simplification()
+        self.instrumentation.report()
+
+    def report_pipeline(self, write_queue):
+        '''
+        Print the throughput of parsing and of the writer threads of a pipelined upload, from its spans
+        :param write_queue: the WriteQueue of the upload
+        '''
+        spans = self.instrumentation.snapshot()["spans"]
+        if "upload.parse" not in spans:
+            return
+
+        # the parser was only busy while it was not waiting for room in the queue
+        points = spans["upload.parse"]["counters"].get("points", 0)
+        put_wait = spans.get("queue.wait", {"seconds": 0.0})["seconds"]
+        parse_busy = max(spans["upload.parse"]["seconds"] - put_wait, 1e-9)
+        write_busy = max(sum(entry["seconds"] for name, entry in spans.items() if name.startswith("insert.")), 1e-9)
+        print("Parse: %s trackpoints in %.3f s (%.0f trackpoints/s), %.3f s waiting for a full queue"
+              % (points, parse_busy, points / parse_busy, put_wait))
+        print("Write: %s documents in %s batches, %.3f s over %s writers (%.0f documents/s per writer)"
+              % (write_queue.documents, write_queue.batches, write_busy, len(write_queue.threads),
+                 write_queue.documents / write_busy))
+        print("Writing finished %.3f s after parsing" % spans.get("upload.drain", {"seconds": 0.0})["seconds"])
+
+    def file_state(self, file_path, entry=None):
+        '''
+        Get the size, modification time and content hash of a file
+        :param file_path: path of the file
+        :param entry: manifest entry of the file, its hash is reused when size and modification time are unchanged
+        :return: dict with size, mtime and sha1
+        '''
+        file_stats = os.stat(file_path)
+        state = {"size": file_stats.st_size, "mtime": file_stats.st_mtime}
+
+        if entry is not None and entry.get("size") == state["size"] and entry.get("mtime") == state["mtime"]:
+            state["sha1"] = entry["sha1"]
+        else:
+            with open(file_path, 'rb') as file:
+                state["sha1"] = hashlib.sha1(file.read()).hexdigest()
+        return state
+
+    def remove_file_data(self, entry, summaries=None):
+        '''
+        Delete the activities and trackpoints that were loaded from a file
+        :param entry: manifest entry of the file
+        :param summaries: SummaryCounters to uncount the deleted activities from, None to not track them
+        '''
+        if entry.get("activity_ids") is None:
+            return
+
+        first, last = entry["activity_ids"]
+        if summaries is not None:
+            summaries.add(self.db['Activity'].find({"_id": {"$gte": first, "$lte": last}}, SUMMARY_FIELDS), -1)
+        self.db['Activity'].delete_many({"_id": {"$gte": first, "$lte": last}})
+        self.db[self.trackpoint_collection].delete_many({self.trackpoint_field("activity_id"): {"$gte": first,
+                                                                                               "$lte": last}})
+
+    def trackpoint_field(self, name):
+        '''
+        :return: the path of user_id or activity_id in the trackpoint documents of the layout
+        '''
+        if self.layout == LAYOUT_TIMESERIES:
+            return TIMESERIES_OPTIONS["metaField"] + "." + name
+        return name
+
+    def remove_unrecorded(self, first_activity, summaries=None):
+        '''
+        Delete the activities from first_activity on and their trackpoints. These IDs were not given to any file in
+        the manifest, so anything stored there was left by an interrupted run (or an upload without a manifest)
+        and would otherwise remain as orphans when the files were changed or deleted before the run is resumed
+        :param summaries: SummaryCounters to uncount the deleted activities from, None to not track them
+        '''
+        if summaries is not None:
+            summaries.add(self.db['Activity'].find({"_id": {"$gte": first_activity}}, SUMMARY_FIELDS), -1)
+        self.db['Activity'].delete_many({"_id": {"$gte": first_activity}})
+        self.db[self.trackpoint_collection].delete_many({self.trackpoint_field("activity_id"): {"$gte": first_activity}})
+
+    def update_user(self, user_id, has_labels):
+        '''
+        Rebuild the document of a user from the activities in the database
+        '''
+        activities = self.db['Activity'].find({"user_id": user_id}, {"transportation_mode": 1}).sort("_id", 1)
+        activities_for_user = [{"id": activity["_id"], "transportation_mode": activity["transportation_mode"]}
+                               for activity in activities]
+        self.upsert_data_many("User", [{"_id": user_id, "has_labels": has_labels, "activities": activities_for_user}])
+
+    def upload_data_incremental(self):
+        '''
+        Load only the plt files that are new or changed since the last run, recorded in the manifest collection.
+        A file is reloaded when its content hash changes,
+        all files of a user are reloaded when their labels change or are removed.
+        Every file is written before its manifest entry and what an interrupted run wrote beyond the IDs in the
+        manifest is removed first, so a crashed run is resumed by running again.
+        The summary collections are updated with the changes when they were valid before, else rebuilt at the end.
+        '''
+        with self.instrumentation.span("upload.incremental") as span:
+            loaded_files, removed_files = self.load_changes()
+            span.add(files=loaded_files, removed_files=removed_files)
+        self.report_simplification()
+        self.instrumentation.report()
+
+    def load_changes(self):
+        '''
+        Bring the database up to date with the files, see upload_data_incremental
+        :return: number of files loaded and number of files whose data was removed
+        '''
+        manifest = self.db[MANIFEST_COLLECTION]
+
+        # invalid until this run completes, so that a crashed run makes the next one rebuild them
+        summaries = SummaryCounters() if self.summaries_valid() else None
+        self.set_summaries_valid(False)
+
+        counters = manifest.find_one({"_id": MANIFEST_COUNTERS})
+        if counters is not None:
+            self.ACTIVITY_ID = counters["activity_id"]
+            self.TRACKPOINT_ID = counters["trackpoint_id"]
+
+        # the files of this run get the IDs from here on, for every layout
+        self.remove_unrecorded(self.ACTIVITY_ID, summaries)
+
+        entries = {entry["_id"]: entry for entry in manifest.find({"_id": {"$ne": MANIFEST_COUNTERS}})}
+        seen = set()
+        loaded_files = 0
+
+        for user_id, root, files, label_file in self.iter_user_dirs():
+            labels_changed = False
+            labels_key = os.path.join(user_id, "labels.txt")
+            if label_file != "":
+                seen.add(labels_key)
+                labels_state = self.file_state(label_file, entries.get(labels_key))
+                labels_changed = entries.get(labels_key, {}).get("sha1") != labels_state["sha1"]
+            elif labels_key in entries:
+                # the labels were deleted or the user left labeled_ids.txt, so all files are loaded again without them
+                seen.add(labels_key)
+                labels_changed = True
+
+            changed = []
+            for file_name in files:
+                file_path = root + "/" + file_name
+                key = os.path.relpath(file_path, self.dataset_path)
+                seen.add(key)
+                state = self.file_state(file_path, entries.get(key))
+                if labels_changed or entries.get(key, {}).get("sha1") != state["sha1"]:
+                    changed.append((file_name, key, state))
+                elif entries[key]["mtime"] != state["mtime"]:
+                    manifest.update_one({"_id": key}, {"$set": state})
+
+            if len(changed) == 0 and not labels_changed:
+                continue
+
+            print("Loading %s new or changed files for user: %s" % (len(changed), user_id))
+            labels = LabelIndex(self.get_labels(label_file))
+
+            for file_name, key, state in changed:
+                if key in entries:
+                    self.remove_file_data(entries[key], summaries)
+
+                first_activity = self.ACTIVITY_ID
+                first_trackpoint = self.TRACKPOINT_ID
+                entry = {"_id": key, "user_id": user_id, "activity_ids": None, "trackpoint_ids": None, **state}
+
+                for activities, activities_for_user, trackpoints in self.iter_activities(root, [file_name], labels, user_id):
+                    if summaries is not None:
+                        summaries.add(activities)
+                    self.upsert_data_many('Activity', activities)
+                    if len(trackpoints) > 0:
+                        self.insert_data_many(self.trackpoint_collection, self.trackpoint_documents(trackpoints))
+                    entry["activity_ids"] = [first_activity, self.ACTIVITY_ID - 1]
+                    if self.TRACKPOINT_ID > first_trackpoint:
+                        entry["trackpoint_ids"] = [first_trackpoint, self.TRACKPOINT_ID - 1]
+
+                if self.failed_inserts > 0:
+                    # stops before the manifest entry and with invalid summaries, the next run loads the file again
+                    raise RuntimeError("Not able to write the trackpoints of " + key + ", run again to resume")
+
+                manifest.replace_one({"_id": key}, entry, upsert=True)
+                manifest.replace_one({"_id": MANIFEST_COUNTERS}, {"_id": MANIFEST_COUNTERS,
+                                                                  "activity_id": self.ACTIVITY_ID,
+                                                                  "trackpoint_id": self.TRACKPOINT_ID}, upsert=True)
+                loaded_files += 1
+
+            if label_file != "":
+                manifest.replace_one({"_id": labels_key}, {"_id": labels_key, "user_id": user_id, **labels_state},
+                                     upsert=True)
+            elif labels_key in entries:
+                manifest.delete_one({"_id": labels_key})
+            self.update_user(user_id, label_file != "")
+
+        removed_users = set()
+        removed_files = 0
+        for key, entry in entries.items():
+            if key not in seen:
+                print("Removing data for deleted file: " + key)
+                self.remove_file_data(entry, summaries)
+                manifest.delete_one({"_id": key})
+                removed_users.add(entry["user_id"])
+                removed_files += 1
+
+        for user_id in removed_users:
+            if self.db['Activity'].count_documents({"user_id": user_id}, limit=1) == 0:
+                self.db['User'].delete_one({"_id": user_id})
+            else:
+                user = self.db['User'].find_one({"_id": user_id}, {"has_labels": 1})
+                self.update_user(user_id, user["has_labels"] if user else False)
+
+        if summaries is not None:
+            self.write_summaries(summaries)
+        else:
+            self.rebuild_summaries()
+
+        print("Loaded %s new or changed files" % loaded_files)
+        if loaded_files > 0 or len(removed_users) > 0:
+            self.bump_dataset_version()
+        return loaded_files, removed_files
 
     def drop_collections(self):
         collection = self.db['User']
@@ -245,20 +1159,100 @@ class DataUploader:
         collection = self.db['Activity']
         collection.drop()
 
-        collection = self.db['TrackPoint']
+        for trackpoint_collection in TRACKPOINT_COLLECTIONS.values():
+            collection = self.db[trackpoint_collection]
+            collection.drop()
+
+        collection = self.db[MANIFEST_COLLECTION]
         collection.drop()
 
+        for summary_collection in SUMMARY_COLLECTIONS:
+            collection = self.db[summary_collection]
+            collection.drop()
+        self.set_summaries_valid(False)
+
+        self.bump_dataset_version()
+
 def main():
+    parser = argparse.ArgumentParser(description="Upload the Geolife dataset to the database")
+    parser.add_argument("--stream", action="store_true",
+                        help="insert documents in batches while the files are parsed")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="maximum number of documents per batch when streaming")
+    parser.add_argument("--batch-bytes", type=int, default=None,
+                        help="maximum BSON size in bytes per batch when streaming")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes used to parse the plt files")
+    parser.add_argument("--writers", type=int, default=None,
+                        help="stream with this many threads inserting the batches while parsing continues "
+                             "(e.g. %s), instead of inserting every batch before parsing on" % DEFAULT_WRITERS)
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="number of full batches that can wait for a writer thread")
+    parser.add_argument("--label-overlap", type=float, default=None,
+                        help="match trajectories to labels overlapping them by at least this fraction")
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUT_DOCUMENTS,
+                        help="store trackpoints as one document per point, in buckets per activity "
+                             "or in a time-series collection (MongoDB 5.0 or newer)")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="maximum number of trackpoints in a bucket")
+    parser.add_argument("--dataset", default=DATASET_ROOT_PATH,
+                        help="folder with labeled_ids.txt and the Data folder")
+    parser.add_argument("--incremental", action="store_true",
+                        help="keep the database and only load new or changed files")
+    parser.add_argument("--rebuild-summaries", action="store_true",
+                        help="only count the summary collections again from the Activity collection")
+    parser.add_argument("--no-indexes", action="store_true",
+                        help="do not build the query indexes after the upload")
+    parser.add_argument("--max-points", type=int, default=MAX_POINTS,
+                        help="exclude plt files with more points than this")
+    parser.add_argument("--parse-cache", nargs="?", const=PARSE_CACHE_PATH, default=None, metavar="DIR",
+                        help="load parsed users from and store them in a local cache (default folder %s)"
+                             % PARSE_CACHE_PATH)
+    parser.add_argument("--simplify", type=float, default=None, metavar="METRES",
+                        help="drop trackpoints within METRES of the trajectory simplified with Douglas-Peucker")
+    parser.add_argument("--simplify-mode", choices=SIMPLIFY_MODES, default="spatial",
+                        help="measure the distance of a point to the simplified trajectory in space, "
+                             "or to the position at the same time")
+    parser.add_argument("--no-raw-bson", action="store_true",
+                        help="let pymongo encode the trackpoint documents instead of packing their BSON directly")
+    parser.add_argument("--no-instrumentation", action="store_true",
+                        help="record no spans or command metrics, and skip the work done only to count them")
+    parser.add_argument("--metrics", default=None, metavar="FILE",
+                        help="write the ingest metrics to FILE, in the Prometheus format for .prom files and as JSON otherwise")
+    args = parser.parse_args()
+
     program = None
     try:
-        program = DataUploader()
-        program.drop_collections()
-        program.create_collections()
-        program.upload_data()
+        program = DataUploader(label_overlap=args.label_overlap, layout=args.layout, bucket_size=args.bucket_size,
+                               dataset_root=args.dataset, raw_bson=not args.no_raw_bson, max_points=args.max_points,
+                               parse_cache=ParseCache(args.parse_cache) if args.parse_cache else None,
+                               simplify_tolerance=args.simplify, simplify_mode=args.simplify_mode,
+                               instrumentation=Instrumentation(enabled=not args.no_instrumentation))
+        if args.rebuild_summaries:
+            program.rebuild_summaries()
+            program.bump_dataset_version()
+            return
+        if args.incremental:
+            program.create_collections(existing_ok=True)
+            program.upload_data_incremental()
+        elif args.stream or args.writers:
+            program.drop_collections()
+            program.create_collections()
+            program.upload_data_streaming(args.batch_size, args.batch_bytes, args.workers, args.writers,
+                                          args.queue_size)
+        else:
+            program.drop_collections()
+            program.create_collections()
+            program.upload_data(args.workers)
+        if not args.no_indexes:
+            from IndexBuilder import IndexBuilder
+            IndexBuilder(program.db).build()
     except Exception as e:
-        print("ERROR: Failed to use database:", e.with_traceback())
+        print("ERROR: Failed to use database:", e)
     finally:
         if program:
+            if args.metrics:
+                program.instrumentation.write(args.metrics)
             program.connection.close_connection()
 
 if __name__ == '__main__':
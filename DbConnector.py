@@ -1,12 +1,18 @@
 from pymongo import MongoClient, version
+import importlib.util
 import os
+import threading
 from dotenv import load_dotenv
 
 
 class DbConnector:
     """
     Connects to the MongoDB server on the Ubuntu virtual machine.
-    Connector needs HOST, USER and PASSWORD to connect.
+    Connector needs HOST, USER and PASSWORD to connect, or a full mongodb:// URI (e.g. MONGODB_URI in .env).
+
+    Connectors with the same URI and settings share one MongoClient (and its connection pool) in the process,
+    the client is closed when the last of them is closed. The client settings come from one of PROFILES,
+    any MongoClient option given as keyword argument overrides the profile.
 
     Example:
     HOST = "tdt4225-00.idi.ntnu.no" // Your server IP address/domain name
@@ -17,16 +23,53 @@ class DbConnector:
     BASEDIR = os.path.abspath(os.path.dirname(__file__))
     load_dotenv(os.path.join(BASEDIR, '.env'))
 
+    # wire compression, zstd and snappy need the optional zstandard and python-snappy packages
+    COMPRESSORS = ",".join([name for name, module in (("zstd", "zstandard"), ("snappy", "snappy"))
+                            if importlib.util.find_spec(module) is not None] + ["zlib"])
+
+    PROFILES = {
+        "default": {},
+        # bulk loads: acknowledged by the primary only, not waiting for the journal
+        "ingest": {
+            "w": 1,
+            "journal": False,
+            "compressors": COMPRESSORS,
+            "maxPoolSize": 32,
+            "socketTimeoutMS": 600000,
+            "serverSelectionTimeoutMS": 30000,
+        },
+        # long running aggregations, read from a secondary when there is one
+        "query": {
+            "readPreference": "secondaryPreferred",
+            "compressors": COMPRESSORS,
+            "maxPoolSize": 32,
+            "socketTimeoutMS": 600000,
+            "serverSelectionTimeoutMS": 30000,
+        },
+    }
+
+    _clients = {}
+    _lock = threading.Lock()
+
     def __init__(self,
                  DATABASE='db_geodata',
                  HOST="tdt4225-37.idi.ntnu.no",
                  USER="group37",
-                 PASSWORD= os.getenv('PASSWORD')):
-        uri = "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+                 PASSWORD= os.getenv('PASSWORD'),
+                 URI=os.getenv('MONGODB_URI'),
+                 profile="default",
+                 shared=True,
+                 **client_options):
+        uri = URI or "mongodb://%s:%s@%s/%s" % (USER, PASSWORD, HOST, DATABASE)
+
+        options = dict(self.PROFILES[profile])
+        options.update(client_options)
+        self.shared = shared
+        self.key = (uri, tuple(sorted((name, repr(value)) for name, value in options.items())))
 
         # Connect to the databases
         try:
-            self.client = MongoClient(uri)
+            self.client = self.get_client(uri, options)
             self.db = self.client[DATABASE]
         except Exception as e:
             print("ERROR: Failed to connect to db:", e)
@@ -35,9 +78,29 @@ class DbConnector:
         print("You are connected to the database:", self.db.name)
         print("-----------------------------------------------\n")
 
+    def get_client(self, uri, options):
+        if not self.shared:
+            return MongoClient(uri, **options)
+
+        with DbConnector._lock:
+            entry = DbConnector._clients.get(self.key)
+            if entry is None:
+                entry = DbConnector._clients[self.key] = [MongoClient(uri, **options), 0]
+            entry[1] += 1
+            return entry[0]
+
     def close_connection(self):
         # close the cursor
-        # close the DB connection
-        self.client.close()
+        # close the DB connection, a shared client is closed with its last connector
+        if self.shared:
+            with DbConnector._lock:
+                entry = DbConnector._clients.get(self.key)
+                if entry is not None:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del DbConnector._clients[self.key]
+                        self.client.close()
+        else:
+            self.client.close()
         print("\n-----------------------------------------------")
         print("Connection to %s-db is closed" % self.db.name)
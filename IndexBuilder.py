@@ -0,0 +1,147 @@
+from DataUploader import LAYOUT_DOCUMENTS, LAYOUTS
+from DbConnector import DbConnector
+from queries import Query
+import argparse
+import sys
+import time
+
+# Secondary indexes for the queries in queries.py, built after the bulk load since maintaining
+# them during millions of inserts is much slower than building them once at the end
+INDEXES = {
+    "Activity": [
+        # q4 (taxi users), q5 and q11 (labeled activities)
+        [("transportation_mode", 1), ("user_id", 1)],
+        # q7 (activities of one user with a mode in a time range)
+        [("user_id", 1), ("transportation_mode", 1), ("start_date_time", 1)],
+        # q9 (activities with a long gap between two points)
+        [("max_time_gap", 1), ("user_id", 1)],
+    ],
+    "TrackPoint": [
+        # points of some activities in recorded order (Query.activity_trackpoints, Query.iter_trackpoints)
+        [("activity_id", 1), ("date_time", 1)],
+        # q10 and the proximity queries (users_near, activities_near, trackpoints_nearest)
+        [("location", "2dsphere"), ("date_time", 1)],
+        # co-location of users (Query.colocated_users)
+        [("time_bucket", 1), ("cell", 1)],
+    ],
+    # time-series collections (MongoDB 6.0 or newer for the secondary and 2dsphere indexes on measurements)
+    "TrackPointSeries": [
+        [("meta.activity_id", 1), ("date_time", 1)],
+        [("location", "2dsphere")],
+        [("time_bucket", 1), ("cell", 1)],
+    ],
+    # q4 reads the users of a mode from the summary instead of the activities
+    "UserModeSummary": [
+        [("_id.transportation_mode", 1), ("_id.user_id", 1)],
+    ],
+    "TrackPointBucket": [
+        [("activity_id", 1), ("n", 1)],
+        # bounding box filter of the proximity queries
+        [("min_lat", 1), ("max_lat", 1), ("min_lon", 1), ("max_lon", 1)],
+    ],
+}
+
+# Query methods that filter on indexed fields and should never scan a whole collection.
+# The other methods aggregate over every document of a collection.
+VERIFY_METHODS = ("q4", "q7", "q9", "q10")
+
+
+class IndexBuilder:
+
+    def __init__(self, db):
+        self.db = db
+
+    def build(self, indexes=INDEXES):
+        '''
+        Create the indexes for the collections that exist in the database
+        :param indexes: dict from collection name to a list of index keys
+        :return: list of (collection, index name, seconds to build)
+        '''
+        existing = self.db.list_collection_names()
+        timings = []
+
+        for collection, keys_list in indexes.items():
+            if collection not in existing:
+                continue
+
+            for keys in keys_list:
+                start_time = time.time()
+                name = self.db[collection].create_index(keys)
+                elapsed = time.time() - start_time
+                timings.append((collection, name, elapsed))
+                print("Created index %s on %s in %.2f seconds" % (name, collection, elapsed))
+
+        return timings
+
+    def profile(self, query, method):
+        '''
+        Run a Query method with the profiler on
+        :param query: Query instance connected to the same database
+        :param method: name of the method
+        :return: plan summaries of the operations the method ran
+        '''
+        self.db.command("profile", 0)
+        self.db["system.profile"].drop()
+        self.db.command("profile", 2)
+        try:
+            getattr(query, method)()
+        finally:
+            self.db.command("profile", 0)
+
+        operations = self.db["system.profile"].find({"planSummary": {"$exists": True}}, {"ns": 1, "planSummary": 1})
+        return [(operation["ns"], operation["planSummary"]) for operation in operations]
+
+    def verify(self, query, methods=VERIFY_METHODS):
+        '''
+        Check that none of the given Query methods scans a whole collection
+        :param query: Query instance connected to the same database
+        :param methods: names of the methods
+        :return: dict from method name to the plan summaries of its operations
+        '''
+        plans = {}
+        failed = []
+
+        for method in methods:
+            plans[method] = self.profile(query, method)
+            for ns, plan in plans[method]:
+                print("%s: %s %s" % (method, ns, plan))
+                if "COLLSCAN" in plan:
+                    failed.append(method)
+
+        if failed:
+            raise RuntimeError("Collection scan in: " + ", ".join(sorted(set(failed))))
+
+        return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the indexes used by the queries")
+    parser.add_argument("--verify", nargs="*", metavar="METHOD", default=None,
+                        help="check that the Query methods (default: %s) use no collection scan" % " ".join(VERIFY_METHODS))
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUT_DOCUMENTS,
+                        help="how the trackpoints were stored")
+    args = parser.parse_args()
+
+    connection = None
+    failed = False
+    try:
+        connection = DbConnector()
+        builder = IndexBuilder(connection.db)
+        builder.build()
+        if args.verify is not None:
+            builder.verify(Query(args.layout, connection), args.verify or VERIFY_METHODS)
+            print("No collection scans")
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+        failed = True
+    finally:
+        if connection:
+            connection.close_connection()
+
+    # a failed --verify must fail the CI job running it
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+from DataUploader import DATASET_ROOT_PATH, DEFAULT_BUCKET_SIZE, INVALID_ALTITUDE, LAYOUT_BUCKETS, LAYOUT_DOCUMENTS, \
+    LAYOUTS, TRACKPOINT_COLLECTIONS, DataUploader
+from ParseCache import PARSE_CACHE_PATH, ParseCache
+from plt import MAX_POINTS
+from simplify import SIMPLIFY_MODES
+from QueryRunner import QUERY_METHODS
+from queries import ALTITUDE_GAIN_ENGINES, EARTH_RADIUS_METRES, FEET_TO_METRES, FORBIDDEN_CITY, \
+    FORBIDDEN_CITY_RADIUS, Query
+from contextlib import redirect_stdout
+from datetime import datetime
+from haversine import haversine_vector
+from pprint import pprint
+import argparse
+import io
+import math
+import time
+
+import numpy as np
+
+# Query methods that return a ranking, where entries with the same value may come in any order
+RANKED_METHODS = ("q3", "q8")
+
+
+def distances_metres(lat, lon, lats, lons):
+    '''
+    Great circle distances from a point on the sphere MongoDB uses, see queries.distance_metres
+    '''
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_METRES * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+
+def consecutive(groups):
+    '''
+    :param groups: group of every element, the elements of a group next to each other
+    :return: mask of the elements that follow an element of the same group
+    '''
+    same = np.zeros(len(groups), dtype=bool)
+    same[1:] = groups[1:] == groups[:-1]
+    return same
+
+
+def altitude_gains(activities, altitudes, count):
+    '''
+    Sum the rises between consecutive valid altitudes of every activity
+    :param activities: activity index of every point, the points of an activity next to each other in recorded order
+    :param altitudes: altitude of every point
+    :param count: number of activities
+    :return: altitude gain in feet per activity
+    '''
+    valid = altitudes != INVALID_ALTITUDE
+    activities = activities[valid]
+    altitudes = altitudes[valid]
+    rises = np.zeros(len(altitudes))
+    rises[1:] = np.diff(altitudes)
+    rises[~consecutive(activities) | (rises < 0)] = 0
+    return np.bincount(activities, weights=rises, minlength=count)
+
+
+def same(a, b):
+    '''
+    Compare query results, floats only need to be close since they are summed in another order
+    '''
+    if isinstance(a, float) or isinstance(b, float):
+        return isinstance(a, (int, float)) and isinstance(b, (int, float)) and \
+            math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-6)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[key], b[key]) for key in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return a == b
+
+
+def same_ranking(a, b):
+    '''
+    Compare two rankings of (key, value), highest first. Keys with the same value may be in any order,
+    and the keys with the last value may differ since the ranking could be cut off in the middle of them
+    '''
+    if len(a) != len(b) or not all(same(x[1], y[1]) for x, y in zip(a, b)):
+        return False
+    if len(a) == 0:
+        return True
+    last = a[-1][1]
+    return set(key for key, value in a if not same(value, last)) == \
+        set(key for key, value in b if not same(value, last))
+
+
+class OfflineQuery:
+    '''
+    Answers the questions of Query from NumPy arrays in memory instead of MongoDB.
+
+    Trackpoints are held as one array per field in the order of their _id, so the points of an activity are
+    next to each other. The activity metrics (distance, altitude gain, largest time gap) are computed from them
+    with vectorised differences of consecutive points, so a cross-check also checks the metrics DataUploader
+    stored. Simplified trackpoints no longer give the metrics of all points, for them the metrics stored in the
+    activity documents are used instead. Grouped counts use np.unique and np.bincount.
+    The qN methods return the same values as the Query methods.
+    '''
+
+    def __init__(self, users, activities, trackpoints, layout=LAYOUT_DOCUMENTS, bucket_size=DEFAULT_BUCKET_SIZE,
+                 stored_metrics=False):
+        '''
+        :param users: user documents as DataUploader stores them
+        :param activities: activity documents as DataUploader stores them, ordered by _id
+        :param trackpoints: TrackPointColumns ordered by _id
+        :param layout: layout the trackpoints are counted for in q1, see DataUploader
+        :param bucket_size: maximum number of trackpoints in a bucket of the buckets layout
+        :param stored_metrics: take the activity metrics from the activity documents instead of computing them
+            from the trackpoints, for trackpoints that were simplified
+        '''
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown trackpoint layout: " + str(layout))
+        self.layout = layout
+        self.bucket_size = bucket_size
+        self.users = np.array([user["_id"] for user in users], dtype=str)
+
+        self.activity_ids = np.array([activity["_id"] for activity in activities], dtype=np.int64)
+        self.activity_users = np.array([activity["user_id"] for activity in activities], dtype=str)
+        self.modes = np.array([activity["transportation_mode"] for activity in activities], dtype=str)
+        self.start_times = np.array([activity["start_date_time"] for activity in activities], dtype="datetime64[ms]")
+        self.end_times = np.array([activity["end_date_time"] for activity in activities], dtype="datetime64[ms]")
+
+        lengths = [len(columns) for columns in trackpoints]
+        self.point_activities = np.searchsorted(self.activity_ids, np.repeat(
+            np.array([columns.activity_id for columns in trackpoints], dtype=np.int64), lengths))
+        self.lat = self.column(trackpoints, "lat", np.float64)
+        self.lon = self.column(trackpoints, "lon", np.float64)
+        self.altitude = self.column(trackpoints, "altitude", np.float64)
+        self.times = self.column(trackpoints, "times", np.int64)
+
+        if stored_metrics:
+            self.distance = np.array([activity["distance"] for activity in activities], dtype=np.float64)
+            self.max_time_gap = np.array([activity["max_time_gap"] for activity in activities], dtype=np.float64)
+            self.altitude_gain = np.array([activity["altitude_gain"] for activity in activities], dtype=np.float64)
+            return
+
+        count = len(self.activity_ids)
+        same_activity = consecutive(self.point_activities)[1:]
+        steps = self.point_activities[1:][same_activity]
+
+        self.distance = np.zeros(count)
+        if len(steps) > 0:
+            points = np.column_stack((self.lat, self.lon))
+            self.distance = np.bincount(steps, weights=haversine_vector(points[:-1][same_activity],
+                                                                        points[1:][same_activity]), minlength=count)
+
+        self.max_time_gap = np.zeros(count)
+        np.maximum.at(self.max_time_gap, steps, np.diff(self.times)[same_activity] / 1e6)
+
+        self.altitude_gain = altitude_gains(self.point_activities, self.altitude, count)
+
+    @staticmethod
+    def column(trackpoints, name, dtype):
+        if len(trackpoints) == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate([np.frombuffer(getattr(columns, name), dtype=dtype) for columns in trackpoints])
+
+    @classmethod
+    def from_dataset(cls, dataset_root=DATASET_ROOT_PATH, workers=None, parse_cache=None, label_overlap=None,
+                     max_points=MAX_POINTS, simplify_tolerance=None, simplify_mode="spatial", layout=LAYOUT_DOCUMENTS,
+                     bucket_size=DEFAULT_BUCKET_SIZE):
+        '''
+        Parse the plt files like DataUploader does, the parse settings must be those the database was loaded with
+        :param dataset_root: folder with labeled_ids.txt and the Data folder
+        :param workers: number of processes used to parse the files
+        :param parse_cache: ParseCache to load parsed users from, see DataUploader
+        :param label_overlap: see DataUploader
+        :param max_points: see DataUploader
+        :param simplify_tolerance: see DataUploader
+        :param simplify_mode: see DataUploader
+        :param layout: see OfflineQuery
+        :param bucket_size: see OfflineQuery
+        '''
+        uploader = DataUploader(connect=False, dataset_root=dataset_root, parse_cache=parse_cache,
+                                label_overlap=label_overlap, max_points=max_points,
+                                simplify_tolerance=simplify_tolerance, simplify_mode=simplify_mode)
+        with redirect_stdout(io.StringIO()):
+            users, activities, trackpoints = uploader.read_data(workers)
+        return cls(users, activities, trackpoints, layout, bucket_size, stored_metrics=simplify_tolerance is not None)
+
+    def user_totals(self, values):
+        '''
+        Sum a value per activity for every user that has activities
+        :return: user ids and their totals
+        '''
+        users, activity_users = np.unique(self.activity_users, return_inverse=True)
+        return users, np.bincount(activity_users, weights=values, minlength=len(users))
+
+    @staticmethod
+    def ranking(keys, values, limit):
+        '''
+        :return: list of (key, value) with the highest values first, equal values ordered by key
+        '''
+        order = np.lexsort((keys, -values))[:limit]
+        return [(keys[i].item(), values[i].item()) for i in order]
+
+    def q1(self):
+        """Count the documents in each collection.
+        :return: dict from collection name to number of documents"""
+        trackpoints = len(self.lat)
+        if self.layout == LAYOUT_BUCKETS:
+            points = np.bincount(self.point_activities, minlength=len(self.activity_ids))
+            trackpoints = int(np.sum(-(-points // self.bucket_size)))
+        return {TRACKPOINT_COLLECTIONS[self.layout]: trackpoints, "Activity": len(self.activity_ids),
+                "User": len(self.users)}
+
+    def q2(self):
+        """Find the average number of activities per user.
+        :return: average rounded to whole activities"""
+        return round(len(self.activity_ids) / len(self.users), 0)
+
+    def q3(self):
+        """Find the top 20 users with the highest number of activities.
+        :return: list of (user_id, number of activities)"""
+        users, counts = np.unique(self.activity_users, return_counts=True)
+        return self.ranking(users, counts, 20)
+
+    def q4(self):
+        """Find the users that have taken a taxi.
+        :return: list of user ids"""
+        return np.unique(self.activity_users[self.modes == "taxi"]).tolist()
+
+    def q5(self):
+        """Count the activities per transportation mode.
+        :return: dict from transportation mode to number of activities"""
+        modes, counts = np.unique(self.modes[self.modes != "null"], return_counts=True)
+        return dict(zip(modes.tolist(), counts.tolist()))
+
+    def q6(self):
+        """a) Find the year with the most activities.
+           b) Is this also the year with most recorded hours?
+        :return: (year with most activities, year with most hours)"""
+        if len(self.activity_ids) == 0:
+            return None, None
+        years = self.start_times.astype("datetime64[Y]").astype(np.int64) + 1970
+        first = years.min()
+        activities = np.bincount(years - first)
+        durations = np.bincount(years - first, weights=(self.end_times - self.start_times).astype(np.int64))
+        return int(first + activities.argmax()), int(first + durations.argmax())
+
+    def q7(self):
+        """Find the total distance walked in 2008 by user 112.
+        :return: distance in km"""
+        walks = (self.modes == "walk") & (self.activity_users == "112") & \
+            (self.start_times >= np.datetime64(datetime(2008, 1, 1))) & \
+            (self.end_times < np.datetime64(datetime(2009, 1, 1)))
+        return float(self.distance[walks].sum()) if walks.any() else 0
+
+    def altitude_gain_ranking(self, engine="activity", limit=20):
+        '''
+        Rank the users by the altitude they gained, see Query.altitude_gain_ranking
+        :param engine: "activity" uses the points in recorded order like the altitude_gain of the activities,
+            "window" and "stream" sort the points of every activity by date_time first
+        :return: list of (user_id, altitude gain in feet), highest first
+        '''
+        if engine not in ALTITUDE_GAIN_ENGINES:
+            raise ValueError("Unknown altitude gain engine: " + str(engine))
+
+        gains = self.altitude_gain
+        if engine != "activity":
+            order = np.lexsort((self.times, self.point_activities))
+            gains = altitude_gains(self.point_activities[order], self.altitude[order], len(self.activity_ids))
+        users, totals = self.user_totals(gains)
+        return self.ranking(users, totals, limit)
+
+    def q8(self, engine="activity"):
+        """Find the top 20 users that gained the most altitude.
+        :param engine: see altitude_gain_ranking
+        :return: list of (user_id, altitude gain in metres)"""
+        return [(user_id, float(total) * FEET_TO_METRES) for user_id, total in self.altitude_gain_ranking(engine, 20)]
+
+    def q9(self):
+        """Find all users who have invalid activities, and the number of invalid activities per
+        user
+        An invalid activity is defined as an activity with consecutive trackpoints
+        where the timestamps deviate with at least 5 minutes.
+        :return: dict from user id to number of invalid activities"""
+        users, counts = np.unique(self.activity_users[self.max_time_gap > 5 * 60], return_counts=True)
+        return dict(zip(users.tolist(), counts.tolist()))
+
+    def users_near(self, lat, lon, radius):
+        '''
+        Find the users that have been within radius metres of a point
+        :return: sorted list of user ids
+        '''
+        # bounding box of the circle first, the distance only for the points in it
+        delta_lat = math.degrees(radius / EARTH_RADIUS_METRES)
+        delta_lon = delta_lat / max(math.cos(math.radians(lat)), 1e-12)
+        box = np.flatnonzero((np.abs(self.lat - lat) <= delta_lat) & (np.abs(self.lon - lon) <= delta_lon))
+        near = box[distances_metres(lat, lon, self.lat[box], self.lon[box]) <= radius]
+        return np.unique(self.activity_users[self.point_activities[near]]).tolist()
+
+    def q10(self):
+        """Find the users that have been in the Forbidden City.
+        :return: list of user ids"""
+        lat, lon = FORBIDDEN_CITY
+        return self.users_near(lat, lon, FORBIDDEN_CITY_RADIUS)
+
+    def q11(self):
+        """Find the most used transportation mode of every user that has labeled activities.
+        :return: list of dicts with user_id and most_used_transportation_mode"""
+        labeled = self.modes != "null"
+        users, user_codes = np.unique(self.activity_users[labeled], return_inverse=True)
+        modes, mode_codes = np.unique(self.modes[labeled], return_inverse=True)
+        pairs, counts = np.unique(user_codes * len(modes) + mode_codes, return_counts=True)
+        pair_users, pair_modes = np.divmod(pairs, max(len(modes), 1))
+
+        # like the aggregation: the highest count first, ties broken by the mode in descending order
+        order = np.lexsort((-pair_modes, -counts, pair_users))
+        first = order[~consecutive(pair_users[order])]
+        return [{"user_id": users[pair_users[i]].item(), "most_used_transportation_mode": modes[pair_modes[i]].item()}
+                for i in first]
+
+    def cross_check(self, query, methods=QUERY_METHODS):
+        '''
+        Run the methods on this and on a Query connected to MongoDB, and compare the answers
+        :param query: Query with the same dataset uploaded
+        :param methods: names of the methods
+        :return: dict from method name to (matches, offline answer, MongoDB answer)
+        '''
+        results = {}
+        for method in methods:
+            offline = getattr(self, method)()
+            online = getattr(query, method)()
+            matches = same_ranking(offline, online) if method in RANKED_METHODS else same(offline, online)
+            results[method] = (matches, offline, online)
+            print("%s: %s" % (method, "match" if matches else "MISMATCH"))
+            if not matches:
+                print("  offline: %s\n  mongodb: %s" % (offline, online))
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer the queries from the plt files, without MongoDB")
+    parser.add_argument("queries", nargs="*", default=list(QUERY_METHODS), help="Query methods to run (default: all)")
+    parser.add_argument("--dataset", default=DATASET_ROOT_PATH, help="folder with labeled_ids.txt and the Data folder")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes used to parse the plt files")
+    parser.add_argument("--parse-cache", nargs="?", const=PARSE_CACHE_PATH, default=None, metavar="DIR",
+                        help="load parsed users from and store them in a local cache (default folder %s)"
+                             % PARSE_CACHE_PATH)
+    parser.add_argument("--cross-check", action="store_true",
+                        help="compare the answers with the Query methods on the database")
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUT_DOCUMENTS,
+                        help="how the trackpoints were stored, for q1 and --cross-check")
+    parser.add_argument("--bucket-size", type=int, default=DEFAULT_BUCKET_SIZE,
+                        help="maximum number of trackpoints in a bucket")
+    # the same parse settings as DataUploader, a cross-check needs the ones the database was loaded with
+    parser.add_argument("--label-overlap", type=float, default=None,
+                        help="match trajectories to labels overlapping them by at least this fraction")
+    parser.add_argument("--max-points", type=int, default=MAX_POINTS,
+                        help="exclude plt files with more points than this")
+    parser.add_argument("--simplify", type=float, default=None, metavar="METRES",
+                        help="drop trackpoints within METRES of the trajectory simplified with Douglas-Peucker")
+    parser.add_argument("--simplify-mode", choices=SIMPLIFY_MODES, default="spatial",
+                        help="measure the distance of a point to the simplified trajectory in space, "
+                             "or to the position at the same time")
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    offline = OfflineQuery.from_dataset(args.dataset, args.workers,
+                                        ParseCache(args.parse_cache) if args.parse_cache else None,
+                                        args.label_overlap, args.max_points, args.simplify, args.simplify_mode,
+                                        args.layout, args.bucket_size)
+    print("Loaded %s trackpoints in %.3f seconds" % (len(offline.lat), time.perf_counter() - start_time))
+
+    if args.cross_check:
+        query = None
+        try:
+            query = Query(args.layout)
+            results = offline.cross_check(query, args.queries)
+            print("%s of %s queries match" % (sum(matches for matches, _, _ in results.values()), len(results)))
+        except Exception as e:
+            print("ERROR: Failed to use database:", e)
+        finally:
+            if query:
+                query.connection.close_connection()
+        return
+
+    for name in args.queries:
+        start_time = time.perf_counter()
+        result = getattr(offline, name)()
+        print("%s (%.4f seconds):" % (name, time.perf_counter() - start_time))
+        pprint(result)
+
+
+if __name__ == '__main__':
+    main()
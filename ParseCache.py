@@ -0,0 +1,90 @@
+import hashlib
+import os
+import pickle
+
+PARSE_CACHE_PATH = "./.parse_cache"
+
+# bump when the parsed form of a user changes, so that old cache files are not used
+FORMAT_VERSION = 2
+
+
+class ParseCache:
+    '''
+    Local cache of parsed users, so that a new upload does not have to read the plt files again.
+
+    Every user is stored in one file holding what parse_user returns: the activities, the activities for the
+    user document and the TrackPointColumns of the user, with IDs starting at 1 as DataUploader.shift_ids expects,
+    and the counters of the simplify span of the user, so that a run loading it can still report the simplification.
+    The trackpoint columns are stored as the raw bytes of their arrays, so loading them is mostly a copy.
+    The file name contains a hash of the size and modification time of every plt file and the labels file
+    of the user and of the parse settings, any change of those makes the user parsed again.
+    '''
+
+    def __init__(self, path=PARSE_CACHE_PATH):
+        '''
+        :param path: folder for the cache files, created when needed
+        '''
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, user_dir, settings):
+        '''
+        :param user_dir: (user_id, root, plt_files, label_file) as given by DataUploader.iter_user_dirs
+        :param settings: parse settings that change the result, e.g. label_overlap and max_points
+        :return: hex digest identifying the current source files of the user
+        '''
+        user_id, root, files, label_file = user_dir
+        sources = [os.path.join(root, file_name) for file_name in files]
+        if label_file != "":
+            sources.append(label_file)
+
+        digest = hashlib.sha1(repr((FORMAT_VERSION, sorted(settings.items()))).encode())
+        for source in sources:
+            file_stats = os.stat(source)
+            digest.update(repr((os.path.basename(source), file_stats.st_size, file_stats.st_mtime_ns)).encode())
+        return digest.hexdigest()
+
+    def file_path(self, user_id, fingerprint):
+        return os.path.join(self.path, "%s-%s.pickle" % (user_id, fingerprint))
+
+    def load(self, user_dir, settings):
+        '''
+        :return: (activities, activities_for_user, trackpoints, simplify counters) of the user,
+            None if it is not cached
+        '''
+        try:
+            with open(self.file_path(user_dir[0], self.fingerprint(user_dir, settings)), "rb") as file:
+                parsed = pickle.load(file)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return parsed
+
+    def store(self, user_dir, settings, parsed):
+        '''
+        Store a parsed user, replacing older versions of it
+        :param parsed: (activities, activities_for_user, trackpoints, simplify counters) with IDs starting at 1,
+            the counters are None when they were not recorded
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        user_id = user_dir[0]
+        file_path = self.file_path(user_id, self.fingerprint(user_dir, settings))
+
+        # written under a temporary name first, so that an interrupted run leaves no partial file
+        with open(file_path + ".tmp", "wb") as file:
+            pickle.dump(parsed, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(file_path + ".tmp", file_path)
+
+        for name in os.listdir(self.path):
+            if name.startswith(user_id + "-") and os.path.join(self.path, name) != file_path:
+                os.remove(os.path.join(self.path, name))
+
+    def clear(self):
+        '''
+        Delete all cache files
+        '''
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                os.remove(os.path.join(self.path, name))
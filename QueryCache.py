@@ -0,0 +1,94 @@
+from DataUploader import DATASET_VERSION, META_COLLECTION
+from collections import OrderedDict
+from pymongo import ReadPreference
+import json
+import threading
+
+QUERY_CACHE_COLLECTION = "QueryCache"
+
+
+class QueryCache:
+    '''
+    Cache for the results of Query methods, kept in memory with a least recently used policy and
+    optionally persisted in a collection so that they survive the process.
+
+    Every key includes the dataset version that DataUploader bumps whenever it changes the data,
+    so results computed on older data are never returned.
+    '''
+
+    def __init__(self, db, max_entries=128, persist=False):
+        '''
+        :param db: database with the data and the version stamp
+        :param max_entries: number of results kept in memory
+        :param persist: also store the results in the QueryCache collection
+        '''
+        self.db = db
+        self.max_entries = max_entries
+        self.persist = persist
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def dataset_version(self):
+        '''
+        Read the version stamp of the data, from the primary since a lagging secondary would give the version
+        of older data and with it the results cached for that data
+        '''
+        meta = self.db[META_COLLECTION].with_options(read_preference=ReadPreference.PRIMARY).find_one(
+            {"_id": DATASET_VERSION})
+        return meta["version"] if meta is not None else 0
+
+    def get(self, key, compute):
+        '''
+        Get a result from the cache, or compute and store it
+        :param key: list describing the query and its parameters, must be serializable as JSON
+        :param compute: function computing the result
+        :return: the result
+        '''
+        version = self.dataset_version()
+        cache_key = json.dumps([version] + list(key), default=str, sort_keys=True)
+
+        with self.lock:
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return self.entries[cache_key]
+
+        if self.persist:
+            document = self.db[QUERY_CACHE_COLLECTION].find_one({"_id": cache_key})
+            if document is not None:
+                self.store(cache_key, document["result"])
+                with self.lock:
+                    self.hits += 1
+                return document["result"]
+
+        result = compute()
+        self.store(cache_key, result)
+        with self.lock:
+            self.misses += 1
+
+        if self.persist:
+            collection = self.db[QUERY_CACHE_COLLECTION]
+            collection.replace_one({"_id": cache_key}, {"_id": cache_key, "version": version, "result": result},
+                                   upsert=True)
+            collection.delete_many({"version": {"$ne": version}})
+
+        return result
+
+    def store(self, cache_key, result):
+        with self.lock:
+            self.entries[cache_key] = result
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Remove all cached results
+        '''
+        with self.lock:
+            self.entries.clear()
+        if self.persist:
+            self.db[QUERY_CACHE_COLLECTION].drop()
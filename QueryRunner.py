@@ -0,0 +1,151 @@
+from DataUploader import LAYOUT_DOCUMENTS, LAYOUTS
+from concurrent.futures import ThreadPoolExecutor
+from DbConnector import DbConnector
+from instrumentation import Instrumentation
+from queries import Query
+from tabulate import tabulate
+import argparse
+import json
+import time
+
+QUERY_METHODS = tuple("q%d" % i for i in range(1, 12))
+
+
+class QueryRunner:
+    '''
+    Runs Query methods concurrently on a thread pool sharing the client of one Query,
+    with at most max_in_flight of them running on the server at the same time
+    '''
+
+    def __init__(self, query, max_in_flight=4):
+        '''
+        :param query: Query instance
+        :param max_in_flight: maximum number of methods running at the same time
+        '''
+        self.query = query
+        self.max_in_flight = max_in_flight
+
+    def run_one(self, name):
+        '''
+        Run a single Query method
+        :param name: name of the method
+        :return: dict with query, result, error (None when it succeeded) and seconds
+        '''
+        start_time = time.perf_counter()
+        result = None
+        error = None
+        try:
+            result = getattr(self.query, name)()
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+
+        return {
+            "query": name,
+            "result": result,
+            "error": error,
+            "seconds": time.perf_counter() - start_time
+        }
+
+    def run(self, names=QUERY_METHODS, repeat=1):
+        '''
+        Run Query methods concurrently
+        :param names: names of the methods
+        :param repeat: number of times every method is run
+        :return: dict with wall_seconds and runs, a list of run_one results in the order of names
+        '''
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            runs = list(pool.map(self.run_one, [name for _ in range(repeat) for name in names]))
+
+        return {
+            "wall_seconds": time.perf_counter() - start_time,
+            "max_in_flight": self.max_in_flight,
+            "runs": runs
+        }
+
+
+def summarize(report):
+    '''
+    Latency per query of a QueryRunner.run report
+    :return: list of (query, runs, errors, min, mean, max seconds)
+    '''
+    per_query = {}
+    for run in report["runs"]:
+        per_query.setdefault(run["query"], []).append(run)
+
+    rows = []
+    for name, runs in per_query.items():
+        seconds = [run["seconds"] for run in runs]
+        errors = sum(1 for run in runs if run["error"] is not None)
+        rows.append((name, len(runs), errors, min(seconds), sum(seconds) / len(seconds), max(seconds)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the queries concurrently and report their latency")
+    parser.add_argument("queries", nargs="*", default=list(QUERY_METHODS), help="Query methods to run (default: all)")
+    parser.add_argument("--concurrency", type=int, default=4, help="maximum number of queries running at once")
+    parser.add_argument("--repeat", type=int, default=1, help="number of times every query is run")
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUT_DOCUMENTS, help="how the trackpoints were stored")
+    parser.add_argument("--cache", action="store_true", help="cache the query results")
+    parser.add_argument("--no-summaries", action="store_true",
+                        help="aggregate the Activity collection instead of reading the summary collections")
+    parser.add_argument("--json", metavar="FILE", help="write the results and timings to this file")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write the query and command metrics to FILE, in the Prometheus format for .prom files")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the queries on the primary with the profiler on and report the documents and keys "
+                             "the server examined per command")
+    args = parser.parse_args()
+
+    query = None
+    try:
+        instrumentation = Instrumentation() if args.metrics or args.profile else None
+        connection = None
+        if args.profile:
+            # the profiler only records the operations of the server it is enabled on
+            connection = DbConnector(profile="query", readPreference="primary",
+                                     event_listeners=instrumentation.event_listeners())
+        query = Query(args.layout, connection, cache=True if args.cache else None, instrumentation=instrumentation,
+                      summaries=not args.no_summaries)
+
+        if args.profile:
+            query.db.command("profile", 0)
+            query.db["system.profile"].drop()
+            query.db.command("profile", 2)
+        try:
+            report = QueryRunner(query, args.concurrency).run(args.queries, args.repeat)
+        finally:
+            if args.profile:
+                query.db.command("profile", 0)
+                instrumentation.collect_profile(query.db)
+
+        for run in report["runs"][:len(args.queries)]:
+            print("%s: %s" % (run["query"], run["error"] or run["result"]))
+
+        print()
+        print(tabulate(summarize(report), headers=["query", "runs", "errors", "min s", "mean s", "max s"],
+                       floatfmt=".3f"))
+        print("Wall clock: %.3f seconds with at most %s queries in flight" % (report["wall_seconds"], args.concurrency))
+
+        if args.profile:
+            commands = instrumentation.snapshot()["commands"]
+            print()
+            print(tabulate([(name, entry["count"], entry.get("documents_examined", 0), entry.get("keys_examined", 0),
+                             entry["documents_returned"]) for name, entry in sorted(commands.items())],
+                           headers=["command", "count", "docs examined", "keys examined", "docs returned"]))
+
+        if args.json:
+            with open(args.json, "w") as file:
+                json.dump(report, file, default=str, indent=2)
+        if args.metrics:
+            query.instrumentation.write(args.metrics)
+    except Exception as e:
+        print("ERROR: Failed to use database:", e)
+    finally:
+        if query:
+            query.connection.close_connection()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,19 @@
+'''
+Benchmarks for the ingest and the queries, run from the repository root as python -m benchmarks.<name>
+'''
+
+import time
+
+
+def best_of(repeat, function):
+    '''
+    :return: the lowest wall clock time in seconds of repeat calls of function
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
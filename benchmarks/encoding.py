@@ -0,0 +1,111 @@
+'''
+Benchmark for writing trackpoint documents.
+
+Compares building a dict per point and encoding it with bson (what pymongo does with the documents given
+to insert_many) with packing the BSON directly by TrackPointColumns.raw_documents, and checks that both
+give the same bytes. With --uri both are also inserted into a scratch database, unordered, as DataUploader does.
+
+Run from the repository root:
+    python -m benchmarks.encoding [--uri mongodb://localhost:27017]
+'''
+
+from datetime import datetime, timedelta
+import argparse
+import random
+
+import bson
+import pymongo
+
+from benchmarks import best_of
+from trackpoints import TrackPointColumns
+
+
+def make_columns(files, points, seed=0):
+    '''
+    Make TrackPointColumns like the ones of parsed plt files, one point every 2 seconds
+    '''
+    rng = random.Random(seed)
+    result = []
+    first_id = 1
+    for activity_id in range(1, files + 1):
+        columns = TrackPointColumns("%03d" % (activity_id % 182), activity_id, first_id)
+        start = datetime(2008, 10, 23, 2, 53, 4) + timedelta(days=activity_id)
+        columns.extend([39.9 + rng.random() / 10 for _ in range(points)],
+                       [116.3 + rng.random() / 10 for _ in range(points)],
+                       [float(rng.randint(-777, 500)) for _ in range(points)],
+                       [39744.1 + activity_id + i / 43200 for i in range(points)],
+                       [start + timedelta(seconds=2 * i) for i in range(points)])
+        result.append(columns)
+        first_id += points
+    return result
+
+
+def dict_documents(trackpoints):
+    return (document for columns in trackpoints for document in columns.documents())
+
+
+def raw_documents(trackpoints):
+    return (document for columns in trackpoints for document in columns.raw_documents())
+
+
+WRITERS = (("dict + bson.encode", dict_documents), ("raw_documents", raw_documents))
+
+
+def insert(collection, documents, batch_size):
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encoding trackpoint documents")
+    parser.add_argument("--files", type=int, default=100, help="number of plt files")
+    parser.add_argument("--points", type=int, default=2000, help="points per plt file")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is reported")
+    parser.add_argument("--uri", default=None, help="also insert the documents into this mongod")
+    parser.add_argument("--batch-size", type=int, default=10000, help="documents per insert_many")
+    args = parser.parse_args()
+
+    trackpoints = make_columns(args.files, args.points)
+    count = args.files * args.points
+
+    for expected, document in zip(dict_documents(trackpoints), raw_documents(trackpoints)):
+        assert bson.encode(expected) == document.raw
+
+    print("Encoded %s trackpoints, best of %s runs" % (count, args.repeat))
+    baseline = None
+    for name, writer in WRITERS:
+        elapsed = best_of(args.repeat, lambda: [bson.encode(document, check_keys=True)
+                                                for document in writer(trackpoints)])
+        baseline = baseline or elapsed
+        print(" {:<20} {:8.3f} s  {:12.0f} docs/s  {:6.1f}x".format(name, elapsed, count / elapsed,
+                                                                      baseline / elapsed))
+
+    if args.uri is None:
+        return
+
+    client = pymongo.MongoClient(args.uri)
+    collection = client["benchmark_encoding"]["TrackPoint"]
+    print("Inserted %s trackpoints, best of %s runs" % (count, args.repeat))
+    baseline = None
+    try:
+        for name, writer in WRITERS:
+            def run():
+                collection.drop()
+                insert(collection, writer(trackpoints), args.batch_size)
+            elapsed = best_of(args.repeat, run)
+            baseline = baseline or elapsed
+            print(" {:<20} {:8.3f} s  {:12.0f} docs/s  {:6.1f}x".format(name, elapsed, count / elapsed,
+                                                                          baseline / elapsed))
+    finally:
+        client.drop_database("benchmark_encoding")
+        client.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+'''
+Memory benchmark for the parsed trackpoints.
+
+Parses a synthetic dataset into TrackPointColumns and measures with tracemalloc how much memory they hold,
+compared to the same points as a list of trackpoint documents (one dict per point, as they were kept
+before), scaled to a million points. The size of the array data alone (TrackPointColumns.nbytes) shows what
+the columns cost beyond their values.
+
+Run from the repository root:
+    python -m benchmarks.memory
+'''
+
+from contextlib import redirect_stdout
+import argparse
+import gc
+import io
+import tempfile
+import tracemalloc
+
+from DataUploader import DataUploader
+from benchmarks.synthetic import generate
+
+MILLION = 1000000
+
+
+def retained(build):
+    '''
+    :return: the result of build and the memory in bytes it still holds afterwards
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, after - before
+
+
+def parse(dataset):
+    uploader = DataUploader(connect=False, dataset_root=dataset)
+    trackpoints = []
+    with redirect_stdout(io.StringIO()):
+        for user_id, label_file, parsed in uploader.iter_users():
+            for activities, activities_for_user, trackpoints_single in parsed:
+                trackpoints.extend(trackpoints_single)
+    return trackpoints
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the memory held by parsed trackpoints")
+    parser.add_argument("--users", type=int, default=10, help="number of synthetic users")
+    parser.add_argument("--files", type=int, default=20, help="plt files per user")
+    parser.add_argument("--points", type=int, default=1000, help="average points per plt file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dataset:
+        generate(dataset, args.users, args.files, args.points)
+        columns, columns_bytes = retained(lambda: parse(dataset))
+
+    points = sum(len(file_columns) for file_columns in columns)
+    documents, documents_bytes = retained(
+        lambda: [document for file_columns in columns for document in file_columns.documents()])
+    assert len(documents) == points
+
+    array_bytes = sum(file_columns.nbytes() for file_columns in columns)
+
+    print("Parsed %s points in %s files" % (points, len(columns)))
+    for name, size in (("dict per point", documents_bytes), ("columns", columns_bytes), ("array data", array_bytes)):
+        print(" {:<16} {:8.1f} bytes/point  {:8.1f} MiB per million points".format(
+            name, size / points, size / points * MILLION / 2 ** 20))
+    print(" columns use %.1fx less memory" % (documents_bytes / columns_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Benchmark for reading plt files.
+
+Compares the old reader (size guess, then readlines and split of the whole file) with plt.read_records
+on a synthetic dataset in which a share of the files has more than max_points points, and reports the files
+on which the two disagree about exclusion.
+
+Run from the repository root:
+    python -m benchmarks.plt_scan
+'''
+
+import argparse
+import os
+import tempfile
+
+from benchmarks import best_of
+from benchmarks.synthetic import generate
+from plt import HEADER_LINES, MAX_POINTS, read_records
+
+
+def read_records_readlines(file_path, max_points=MAX_POINTS):
+    '''
+    The reader used before plt.read_records
+    '''
+    if os.stat(file_path).st_size > 204500:
+        return None
+
+    with open(file_path) as file:
+        records = file.readlines()[HEADER_LINES:]
+        if len(records) > max_points:
+            return None
+        rows = [record.strip().split(',') for record in records]
+        return [(items[0], items[1], items[3], items[4], items[5], items[6]) for items in rows]
+
+
+def plt_files(dataset):
+    result = []
+    for root, dirs, files in os.walk(dataset):
+        result.extend(os.path.join(root, name) for name in files if name.endswith(".plt"))
+    return sorted(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading plt files")
+    parser.add_argument("--users", type=int, default=10, help="number of synthetic users")
+    parser.add_argument("--files", type=int, default=30, help="plt files per user")
+    parser.add_argument("--points", type=int, default=2000, help="average points per plt file")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is reported")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dataset:
+        generate(dataset, args.users, args.files, args.points)
+        files = plt_files(dataset)
+
+        old = [read_records_readlines(file_path) for file_path in files]
+        new = [read_records(file_path) for file_path in files]
+        excluded = sum(records is None for records in new)
+        disagree = [os.path.relpath(file_path, dataset) for file_path, a, b in zip(files, old, new)
+                    if (a is None) != (b is None)]
+        for a, b in zip(old, new):
+            if a is not None and b is not None:
+                assert a == [tuple(field.decode() for field in record) for record in b]
+
+        print("%s plt files, %s excluded, %s excluded differently by the size guess" %
+              (len(files), excluded, len(disagree)))
+        baseline = None
+        for name, reader in (("readlines", read_records_readlines), ("read_records", read_records)):
+            elapsed = best_of(args.repeat, lambda: [reader(file_path) for file_path in files])
+            baseline = baseline or elapsed
+            print(" {:<14} {:8.3f} s  {:8.0f} files/s  {:6.1f}x".format(name, elapsed, len(files) / elapsed,
+                                                                         baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+'''
+Benchmarks for the ingest and the queries, on a synthetic dataset and a local mongod.
+
+    parse    points per second parsed by DataUploader, for each number of worker processes and
+             with an empty and a filled parse cache
+    insert   documents per second for each upload mode, including parsing
+    queries  latency of every Query method after the indexes are built
+    layouts  with --compare-layouts, disk footprint and latency of the trackpoint queries for every
+             trackpoint layout (the timeseries layout needs MongoDB 5.0, its indexes 6.0)
+
+The results are written as JSON. Given the JSON of an earlier run as baseline, the change of every
+throughput and latency is printed so that regressions are visible.
+
+Run from the repository root, with mongod listening on the given URI:
+    python -m benchmarks.suite --uri mongodb://localhost:27017 --output results.json [--baseline old.json]
+'''
+
+from contextlib import redirect_stdout
+import argparse
+import io
+import json
+import os
+import platform
+import tempfile
+import time
+
+import pymongo
+
+from DataUploader import DataUploader, LAYOUT_DOCUMENTS, LAYOUTS
+from DbConnector import DbConnector
+from IndexBuilder import IndexBuilder
+from ParseCache import ParseCache
+from QueryRunner import QUERY_METHODS, QueryRunner, summarize
+from benchmarks import best_of
+from benchmarks.synthetic import generate
+from queries import FORBIDDEN_CITY, Query
+
+UPLOAD_MODES = ("bulk", "streaming")
+
+
+def time_parse(uploader, workers):
+    '''
+    Parse the dataset without a database
+    :return: dict with workers, seconds, activities, points and points_per_second
+    '''
+    activities = 0
+    points = 0
+
+    start_time = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for user_id, label_file, parsed in uploader.iter_users(workers):
+            for activities_single, activities_for_user, trackpoints in parsed:
+                activities += len(activities_single)
+                points += sum(len(columns) for columns in trackpoints)
+    elapsed = time.perf_counter() - start_time
+
+    return {"workers": workers, "seconds": elapsed, "activities": activities, "points": points,
+            "points_per_second": points / elapsed}
+
+
+def bench_parse(dataset, workers_list):
+    '''
+    Parse the dataset with every number of workers, then with an empty and a filled parse cache
+    :return: list of dicts with workers ("cache-cold" and "cache-warm" for the cache), seconds, activities, points
+        and points_per_second
+    '''
+    results = []
+    for workers in workers_list:
+        results.append(time_parse(DataUploader(connect=False, dataset_root=dataset), workers))
+        print("parse   workers=%-3s %10.0f points/s" % (workers, results[-1]["points_per_second"]))
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        for name in ("cache-cold", "cache-warm"):
+            result = time_parse(DataUploader(connect=False, dataset_root=dataset, parse_cache=ParseCache(cache_path)),
+                                None)
+            result["workers"] = name
+            results.append(result)
+            print("parse   %-11s %10.0f points/s" % (name, result["points_per_second"]))
+    return results
+
+
+def bench_insert(dataset, connection, layout, modes=UPLOAD_MODES):
+    '''
+    Upload the dataset into an empty database with every upload mode
+    :return: list of dicts with mode, seconds, documents and documents_per_second
+    '''
+    results = []
+    for mode in modes:
+        uploader = DataUploader(layout=layout, connection=connection, dataset_root=dataset)
+        with redirect_stdout(io.StringIO()):
+            uploader.drop_collections()
+            uploader.create_collections()
+
+            start_time = time.perf_counter()
+            if mode == "streaming":
+                uploader.upload_data_streaming()
+            else:
+                uploader.upload_data()
+            elapsed = time.perf_counter() - start_time
+
+        documents = sum(connection.db[name].estimated_document_count()
+                        for name in ("User", "Activity", uploader.trackpoint_collection))
+        results.append({"mode": mode, "layout": layout, "seconds": elapsed, "documents": documents,
+                        "documents_per_second": documents / elapsed})
+        print("insert  %-10s %10.0f documents/s" % (mode, documents / elapsed))
+    return results
+
+
+def bench_queries(connection, layout, repeat):
+    '''
+    Build the indexes and time every Query method, one at a time
+    :return: list of dicts with query, runs, errors and min/mean/max seconds
+    '''
+    with redirect_stdout(io.StringIO()):
+        IndexBuilder(connection.db).build()
+    report = QueryRunner(Query(layout, connection), max_in_flight=1).run(QUERY_METHODS, repeat)
+
+    results = []
+    for name, runs, errors, minimum, mean, maximum in summarize(report):
+        results.append({"query": name, "runs": runs, "errors": errors, "min_seconds": minimum,
+                        "mean_seconds": mean, "max_seconds": maximum})
+        print("query   %-10s %10.4f s%s" % (name, mean, " (%s errors)" % errors if errors else ""))
+    return results
+
+
+def bench_layouts(dataset, connection, repeat):
+    '''
+    Upload the dataset with every trackpoint layout, then measure the size of the trackpoint collection and
+    the best latency of the queries that read trackpoints
+    :return: list of dicts with layout, collection, upload_seconds, documents, storage_bytes, index_bytes and
+        seconds (query to best seconds, None when the query failed), or layout and error
+    '''
+    results = []
+    for layout in LAYOUTS:
+        uploader = DataUploader(layout=layout, connection=connection, dataset_root=dataset)
+        try:
+            with redirect_stdout(io.StringIO()):
+                uploader.drop_collections()
+                uploader.create_collections()
+                start_time = time.perf_counter()
+                uploader.upload_data()
+                upload_seconds = time.perf_counter() - start_time
+                IndexBuilder(connection.db).build()
+        except Exception as e:
+            results.append({"layout": layout, "error": str(e)})
+            print("layout  %-10s failed: %s" % (layout, e))
+            continue
+
+        stats = connection.db.command("collStats", uploader.trackpoint_collection)
+        query = Query(layout, connection)
+        lat, lon = FORBIDDEN_CITY
+        seconds = {}
+        for name, method in (("q10", query.q10),
+                             ("activities_near", lambda: query.activities_near(lat, lon, 500)),
+                             ("activity_trackpoints", lambda: query.activity_trackpoints(range(1, 101), ["lat", "lon"])),
+                             ("q8_stream", lambda: query.q8("stream")),
+                             ("q8_window", lambda: query.q8("window"))):
+            try:
+                seconds[name] = best_of(repeat, method)
+            except Exception:
+                seconds[name] = None
+
+        result = {"layout": layout, "collection": uploader.trackpoint_collection, "upload_seconds": upload_seconds,
+                  "documents": query.q1()[uploader.trackpoint_collection],
+                  "storage_bytes": stats.get("storageSize", 0), "index_bytes": stats.get("totalIndexSize", 0),
+                  "seconds": seconds}
+        results.append(result)
+        print("layout  %-10s %10.1f MiB data %8.1f MiB indexes  %s" % (
+            layout, result["storage_bytes"] / 2 ** 20, result["index_bytes"] / 2 ** 20,
+            "  ".join("%s=%s" % (name, "-" if value is None else "%.4fs" % value) for name, value in seconds.items())))
+    return results
+
+
+def compare(results, baseline):
+    '''
+    Print the change of every measurement against an earlier run
+    '''
+    print("\nChange against baseline (higher throughput and lower latency are better):")
+    for section, key, metric in (("parse", "workers", "points_per_second"),
+                                 ("insert", "mode", "documents_per_second"),
+                                 ("queries", "query", "mean_seconds"),
+                                 ("layouts", "layout", "storage_bytes")):
+        old = {entry[key]: entry[metric] for entry in baseline.get(section, []) if metric in entry}
+        for entry in results.get(section, []):
+            if metric in entry and entry[key] in old and old[entry[key]] > 0:
+                print(" %-8s %-10s %-22s %+7.1f%%" % (section, entry[key], metric,
+                                                      100 * (entry[metric] / old[entry[key]] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and the queries on a synthetic dataset")
+    parser.add_argument("--uri", default="mongodb://localhost:27017", help="MongoDB to run against")
+    parser.add_argument("--database", default="bench_geodata", help="database to use, it is dropped and recreated")
+    parser.add_argument("--dataset", help="use this dataset instead of generating one")
+    parser.add_argument("--users", type=int, default=20, help="number of synthetic users")
+    parser.add_argument("--files", type=int, default=20, help="number of plt files per synthetic user")
+    parser.add_argument("--points", type=int, default=800, help="average number of points per synthetic plt file")
+    parser.add_argument("--labelled-users", type=float, default=0.3, help="fraction of synthetic users with labels")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic dataset")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count() or 1],
+                        help="numbers of parse processes to benchmark")
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUT_DOCUMENTS, help="how to store the trackpoints")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs of every query")
+    parser.add_argument("--skip-db", action="store_true", help="only benchmark parsing")
+    parser.add_argument("--compare-layouts", action="store_true",
+                        help="also compare the disk footprint and trackpoint query latency of every layout")
+    parser.add_argument("--output", default="bench_results.json", help="file to write the results to")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = args.dataset
+        config = {"dataset": dataset, "layout": args.layout}
+        if dataset is None:
+            dataset = directory
+            config["synthetic"] = generate(dataset, args.users, args.files, args.points, args.labelled_users,
+                                           seed=args.seed)
+            config["synthetic"]["seed"] = args.seed
+
+        results = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {"python": platform.python_version(), "pymongo": pymongo.version,
+                            "machine": platform.machine(), "cpus": os.cpu_count()},
+            "config": config,
+            "parse": bench_parse(dataset, args.workers)
+        }
+
+        if not args.skip_db:
+            connection = DbConnector(DATABASE=args.database, URI=args.uri, profile="ingest")
+            try:
+                connection.client.drop_database(args.database)
+                results["environment"]["server"] = connection.client.server_info()["version"]
+                results["insert"] = bench_insert(dataset, connection, args.layout)
+                results["queries"] = bench_queries(connection, args.layout, args.repeat)
+                if args.compare_layouts:
+                    results["layouts"] = bench_layouts(dataset, connection, args.repeat)
+            finally:
+                connection.close_connection()
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Wrote " + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            compare(results, json.load(file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Deterministic generator for a synthetic dataset in the layout of the Geolife dataset:
+
+    <root>/labeled_ids.txt
+    <root>/Data/<user>/labels.txt
+    <root>/Data/<user>/Trajectory/<start time>.plt
+
+The same arguments and seed always give the same files. Labeled trajectories get a label with their
+exact start and end time, like in Geolife. Files with more than 2500 points are written too, and are
+excluded by DataUploader like the real ones.
+
+Run from the repository root:
+    python -m benchmarks.synthetic ./synthetic --users 20 --files 20 --points 800
+'''
+
+from datetime import datetime, timedelta
+import argparse
+import os
+import random
+
+from DataUploader import INVALID_ALTITUDE
+from queries import FORBIDDEN_CITY
+
+PLT_HEADER = ["Geolife trajectory", "WGS 84", "Altitude is in Feet", "Reserved 3",
+              "0,2,255,My Track,0,0,2,8421376", "0"]
+MODES = ["walk", "bike", "bus", "car", "subway", "train", "taxi", "airplane", "run", "boat"]
+EXCEL_EPOCH = datetime(1899, 12, 30)
+START_DATE = datetime(2007, 4, 1)
+BEIJING = (39.95, 116.35)
+
+
+def write_trajectory(file, rnd, start_time, points, gap_probability):
+    '''
+    Write one plt file as a random walk
+    :return: time of the last point
+    '''
+    lat, lon = FORBIDDEN_CITY if rnd.random() < 0.1 else (BEIJING[0] + rnd.uniform(-0.2, 0.2),
+                                                            BEIJING[1] + rnd.uniform(-0.2, 0.2))
+    altitude = rnd.uniform(0, 300)
+    date_time = start_time
+
+    file.write("\r\n".join(PLT_HEADER) + "\r\n")
+    for i in range(points):
+        if i > 0:
+            lat += rnd.uniform(-0.0002, 0.0002)
+            lon += rnd.uniform(-0.0002, 0.0002)
+            altitude = max(0.0, altitude + rnd.uniform(-5, 5))
+            date_time += timedelta(seconds=rnd.randint(360, 3600) if rnd.random() < gap_probability
+                                   else rnd.randint(1, 5))
+
+        days = (date_time - EXCEL_EPOCH).total_seconds() / 86400
+        written_altitude = INVALID_ALTITUDE if rnd.random() < 0.01 else int(altitude)
+        file.write("%.6f,%.6f,0,%d,%.10f,%s,%s\r\n" % (lat, lon, written_altitude, days,
+                                                       date_time.strftime("%Y-%m-%d"), date_time.strftime("%H:%M:%S")))
+    return date_time
+
+
+def generate(root, users=10, files_per_user=10, points_per_file=500, labelled_users=0.3, labelled_files=0.5,
+             gap_probability=0.002, seed=0):
+    '''
+    Write a synthetic dataset
+    :param root: folder to write the dataset to
+    :param users: number of users
+    :param files_per_user: number of plt files per user
+    :param points_per_file: average number of points per plt file, the actual number varies by +-50%
+    :param labelled_users: fraction of the users that have a labels.txt
+    :param labelled_files: fraction of the files of a labelled user that get a label
+    :param gap_probability: probability that the time to the next point is more than 5 minutes
+    :param seed: random seed
+    :return: dict with the number of users, files, points and labels written
+    '''
+    rnd = random.Random(seed)
+    data_path = os.path.join(root, "Data")
+    labeled_ids = []
+    counts = {"users": users, "files": 0, "points": 0, "labels": 0}
+
+    for user in range(users):
+        user_id = "%03d" % user
+        trajectory_path = os.path.join(data_path, user_id, "Trajectory")
+        os.makedirs(trajectory_path, exist_ok=True)
+
+        labelled = rnd.random() < labelled_users
+        labels = []
+        start_time = START_DATE + timedelta(days=rnd.randint(0, 365))
+
+        for _ in range(files_per_user):
+            points = max(1, int(points_per_file * rnd.uniform(0.5, 1.5)))
+            file_path = os.path.join(trajectory_path, start_time.strftime("%Y%m%d%H%M%S") + ".plt")
+            with open(file_path, "w", newline="") as file:
+                end_time = write_trajectory(file, rnd, start_time, points, gap_probability)
+
+            if labelled and rnd.random() < labelled_files:
+                labels.append("%s\t%s\t%s" % (start_time.strftime("%Y/%m/%d %H:%M:%S"),
+                                              end_time.strftime("%Y/%m/%d %H:%M:%S"), rnd.choice(MODES)))
+
+            counts["files"] += 1
+            counts["points"] += points
+            start_time = end_time + timedelta(hours=rnd.randint(1, 48))
+
+        if labelled:
+            labeled_ids.append(user_id)
+            counts["labels"] += len(labels)
+            with open(os.path.join(data_path, user_id, "labels.txt"), "w") as file:
+                file.write("Start Time\tEnd Time\tTransportation Mode\n")
+                for label in labels:
+                    file.write(label + "\n")
+
+    with open(os.path.join(root, "labeled_ids.txt"), "w") as file:
+        for user_id in labeled_ids:
+            file.write(user_id + "\n")
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic dataset in the Geolife layout")
+    parser.add_argument("root", help="folder to write the dataset to")
+    parser.add_argument("--users", type=int, default=10, help="number of users")
+    parser.add_argument("--files", type=int, default=10, help="number of plt files per user")
+    parser.add_argument("--points", type=int, default=500, help="average number of points per plt file")
+    parser.add_argument("--labelled-users", type=float, default=0.3, help="fraction of users with labels")
+    parser.add_argument("--labelled-files", type=float, default=0.5, help="fraction of labelled files per labelled user")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    counts = generate(args.root, args.users, args.files, args.points, args.labelled_users, args.labelled_files,
+                      seed=args.seed)
+    print("Wrote %(users)s users, %(files)s files, %(points)s points and %(labels)s labels" % counts)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+'''
+Micro-benchmark for the timestamp decoding used when reading plt files.
+
+Compares the old strptime based read_datetime with timestamps.decode_datetime and the
+batch timestamps.decode_datetimes, and checks that all of them return identical values.
+
+Run from the repository root:
+    python -m benchmarks.timestamps
+'''
+
+from datetime import datetime, timedelta
+import argparse
+
+from benchmarks import best_of
+from timestamps import decode_datetime, decode_datetimes
+
+
+def read_datetime_strptime(date_text):
+    date_text = date_text.replace('/', '-')
+    return datetime.strptime(date_text, '%Y-%m-%d %H:%M:%S')
+
+
+def make_columns(count):
+    '''
+    Make date and time columns like the ones in a plt file, one point every 2 seconds
+    '''
+    start = datetime(2008, 10, 23, 2, 53, 4)
+    times = [start + timedelta(seconds=2 * i) for i in range(count)]
+    return [t.strftime('%Y-%m-%d') for t in times], [t.strftime('%H:%M:%S') for t in times]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark plt timestamp decoding")
+    parser.add_argument("--points", type=int, default=200000, help="number of timestamps to decode")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, the best is reported")
+    args = parser.parse_args()
+
+    dates, clocks = make_columns(args.points)
+    texts = [date + ' ' + clock for date, clock in zip(dates, clocks)]
+
+    expected = [read_datetime_strptime(text) for text in texts]
+    assert [decode_datetime(text) for text in texts] == expected
+    assert [decode_datetime(text.replace('-', '/')) for text in texts] == expected
+    assert decode_datetimes(dates, clocks) == expected
+
+    baseline = best_of(args.repeat, lambda: [read_datetime_strptime(text) for text in texts])
+    single = best_of(args.repeat, lambda: [decode_datetime(text) for text in texts])
+    batch = best_of(args.repeat, lambda: decode_datetimes(dates, clocks))
+
+    print("Decoded %s timestamps, best of %s runs" % (args.points, args.repeat))
+    for name, elapsed in (("strptime", baseline), ("decode_datetime", single), ("decode_datetimes", batch)):
+        print(" {:<18} {:8.3f} s  {:12.0f} /s  {:6.1f}x".format(
+            name, elapsed, args.points / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main()
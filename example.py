@@ -4,8 +4,8 @@ from DbConnector import DbConnector
 
 class ExampleProgram:
 
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, connection=None):
+        self.connection = connection or DbConnector()
         self.client = self.connection.client
         self.db = self.connection.db
 
@@ -0,0 +1,250 @@
+'''
+Instrumentation for the ingest and the queries.
+
+Spans time named stages (walk, labels, parse, insert.<collection>, query.<method>) and sum counters such as
+files, points and bytes for them. CommandMetrics is a pymongo command listener that keeps a latency histogram,
+the documents returned and the documents written per command. Documents and keys examined are only known to
+the server, collect_profile reads them from the profiler (see QueryRunner --profile) and they are only exported
+once it has. Everything can be exported as JSON or in the Prometheus text format.
+
+A disabled Instrumentation hands out one shared no-op span and registers no listener, so leaving the
+calls in the code costs next to nothing.
+'''
+
+from pymongo import monitoring
+import json
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Span:
+
+    def __init__(self, instrumentation, name, counters):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.counters = counters
+
+    def add(self, **counters):
+        '''
+        Add to the counters of the span
+        '''
+        for counter, value in counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.record(self.name, time.perf_counter() - self.start_time, **self.counters)
+        return False
+
+
+class NullSpan:
+
+    def add(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class CommandMetrics(monitoring.CommandListener):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def entry(self, command_name):
+        entry = self.commands.get(command_name)
+        if entry is None:
+            entry = self.commands[command_name] = {
+                "count": 0, "failures": 0, "seconds": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1),
+                "documents_returned": 0, "documents_written": 0
+            }
+        return entry
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        reply = event.reply
+        returned = 0
+        cursor = reply.get("cursor")
+        if cursor is not None:
+            returned = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        elif "values" in reply:
+            returned = len(reply["values"])
+        written = reply.get("n", 0) if event.command_name in ("insert", "update", "delete") else 0
+
+        with self.lock:
+            entry = self.entry(event.command_name)
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            entry["buckets"][self.bucket(seconds)] += 1
+            entry["documents_returned"] += returned
+            entry["documents_written"] += written
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        with self.lock:
+            entry = self.entry(event.command_name)
+            entry["count"] += 1
+            entry["failures"] += 1
+            entry["seconds"] += seconds
+            entry["buckets"][self.bucket(seconds)] += 1
+
+    @staticmethod
+    def bucket(seconds):
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                return i
+        return len(LATENCY_BUCKETS)
+
+
+class Instrumentation:
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.commands = CommandMetrics()
+        # time of the last profiled operation added by collect_profile
+        self.profiled_until = None
+
+    def span(self, name, **counters):
+        '''
+        Time a stage, use as context manager
+        :param name: name of the stage
+        :param counters: initial counters, more can be added with Span.add
+        '''
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, counters)
+
+    def record(self, name, seconds, **counters):
+        '''
+        Add a finished span
+        '''
+        if not self.enabled:
+            return
+        with self.lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                entry = self.spans[name] = {"count": 0, "seconds": 0.0, "counters": {}}
+            entry["count"] += 1
+            entry["seconds"] += seconds
+            for counter, value in counters.items():
+                entry["counters"][counter] = entry["counters"].get(counter, 0) + value
+
+    def merge(self, spans):
+        '''
+        Add the spans of another Instrumentation, e.g. of a worker process
+        :param spans: the "spans" part of Instrumentation.snapshot
+        '''
+        if not self.enabled:
+            return
+        for name, entry in spans.items():
+            with self.lock:
+                own = self.spans.setdefault(name, {"count": 0, "seconds": 0.0, "counters": {}})
+                own["count"] += entry["count"]
+                own["seconds"] += entry["seconds"]
+                for counter, value in entry["counters"].items():
+                    own["counters"][counter] = own["counters"].get(counter, 0) + value
+
+    def event_listeners(self):
+        '''
+        Command listeners for MongoClient(event_listeners=...), none when disabled
+        '''
+        return [self.commands] if self.enabled else []
+
+    def collect_profile(self, db):
+        '''
+        Add the documents and keys examined by the server from the profiler collection,
+        for the operations profiled since the last call
+        :param db: database with profiling enabled
+        '''
+        since = {} if self.profiled_until is None else {"ts": {"$gt": self.profiled_until}}
+        operations = db["system.profile"].find(since, {"command": 1, "op": 1, "docsExamined": 1, "keysExamined": 1,
+                                                       "ts": 1}).sort("ts", 1)
+        with self.commands.lock:
+            for operation in operations:
+                self.profiled_until = operation["ts"]
+                command = operation.get("command") or {}
+                name = next(iter(command), operation.get("op", "unknown"))
+                entry = self.commands.entry(name)
+                entry["documents_examined"] = entry.get("documents_examined", 0) + operation.get("docsExamined", 0)
+                entry["keys_examined"] = entry.get("keys_examined", 0) + operation.get("keysExamined", 0)
+
+    def snapshot(self):
+        '''
+        :return: dict with all spans and command metrics
+        '''
+        with self.lock, self.commands.lock:
+            return json.loads(json.dumps({"spans": self.spans, "commands": self.commands.commands}))
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def to_prometheus(self, prefix="geolife"):
+        '''
+        :return: the metrics in the Prometheus text exposition format
+        '''
+        snapshot = self.snapshot()
+        spans = sorted(snapshot["spans"].items())
+        # the samples of a metric must follow its TYPE line as one group
+        lines = ["# TYPE %s_span_seconds_total counter" % prefix]
+        for name, entry in spans:
+            lines.append('%s_span_seconds_total{span="%s"} %r' % (prefix, name, entry["seconds"]))
+        lines.append("# TYPE %s_span_count_total counter" % prefix)
+        for name, entry in spans:
+            lines.append('%s_span_count_total{span="%s"} %d' % (prefix, name, entry["count"]))
+        lines.append("# TYPE %s_span_counter_total counter" % prefix)
+        for name, entry in spans:
+            for counter, value in sorted(entry["counters"].items()):
+                lines.append('%s_span_counter_total{span="%s",counter="%s"} %r' % (prefix, name, counter, value))
+
+        lines.append("# TYPE %s_command_duration_seconds histogram" % prefix)
+        for name, entry in sorted(snapshot["commands"].items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), entry["buckets"]):
+                cumulative += count
+                lines.append('%s_command_duration_seconds_bucket{command="%s",le="%s"} %d'
+                             % (prefix, name, bound, cumulative))
+            lines.append('%s_command_duration_seconds_sum{command="%s"} %r' % (prefix, name, entry["seconds"]))
+            lines.append('%s_command_duration_seconds_count{command="%s"} %d' % (prefix, name, entry["count"]))
+
+        for metric in ("failures", "documents_returned", "documents_written", "documents_examined", "keys_examined"):
+            # the examined counters are only there for commands collect_profile found in the profiler
+            samples = [(name, entry[metric]) for name, entry in sorted(snapshot["commands"].items()) if metric in entry]
+            if len(samples) == 0:
+                continue
+            lines.append("# TYPE %s_command_%s_total counter" % (prefix, metric))
+            for name, value in samples:
+                lines.append('%s_command_%s_total{command="%s"} %d' % (prefix, metric, name, value))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, file_path):
+        '''
+        Write the metrics to a file, in the Prometheus format for .prom files and as JSON otherwise
+        '''
+        with open(file_path, "w") as file:
+            file.write(self.to_prometheus() if file_path.endswith(".prom") else self.to_json())
+
+    def report(self):
+        '''
+        Print the spans
+        '''
+        for name, entry in sorted(self.snapshot()["spans"].items()):
+            counters = ", ".join("%s=%s" % item for item in sorted(entry["counters"].items()))
+            print("%-24s %10.3f s %8d x  %s" % (name, entry["seconds"], entry["count"], counters))
@@ -0,0 +1,77 @@
+'''
+Index over the labeled activities (labels.txt) of a single user.
+
+Trajectories are matched to labels on their exact (start_time, end_time) with a hash lookup. Optionally,
+trajectories without an exact match can be given the mode of the label that overlaps them the most,
+found through the labels sorted by start time.
+'''
+
+from bisect import bisect_right
+
+
+class LabelIndex:
+
+    def __init__(self, activities_with_labels):
+        '''
+        :param activities_with_labels: list of [start_time, end_time, transportation_mode] in labels.txt order
+        '''
+        self.exact = {}
+        for activity in activities_with_labels:
+            self.exact.setdefault((activity[0], activity[1]), []).append(activity[2])
+
+        # labels sorted by start time, with the running maximum end time so that the search for
+        # overlapping labels can stop as soon as no earlier label reaches the trajectory
+        self.intervals = sorted(((activity[0], activity[1], order, activity[2])
+                                 for order, activity in enumerate(activities_with_labels)),
+                                key=lambda interval: (interval[0], interval[2]))
+        self.starts = [interval[0] for interval in self.intervals]
+        self.max_ends = []
+        for interval in self.intervals:
+            if len(self.max_ends) == 0 or interval[1] > self.max_ends[-1]:
+                self.max_ends.append(interval[1])
+            else:
+                self.max_ends.append(self.max_ends[-1])
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def overlapping(self, start_time, end_time):
+        '''
+        Find the labels that overlap a trajectory
+        :param start_time: start time of the trajectory
+        :param end_time: end time of the trajectory
+        :return: list of (label_start, label_end, order in labels.txt, transportation_mode)
+        '''
+        result = []
+        i = bisect_right(self.starts, end_time) - 1
+        while i >= 0 and self.max_ends[i] >= start_time:
+            if self.intervals[i][1] >= start_time:
+                result.append(self.intervals[i])
+            i -= 1
+        return result
+
+    def match(self, start_time, end_time, min_overlap=None):
+        '''
+        Find the transportation modes for a trajectory
+        :param start_time: start time of the trajectory
+        :param end_time: end time of the trajectory
+        :param min_overlap: if set, a trajectory without an exact match gets the mode of the label with the highest
+            overlap (intersection over union of the two time intervals) when it is at least this fraction
+        :return: list of transportation modes, one for every matching label; empty if no label matches
+        '''
+        modes = self.exact.get((start_time, end_time))
+        if modes is not None:
+            return modes
+
+        if min_overlap is None:
+            return []
+
+        best = None
+        for label_start, label_end, order, mode in self.overlapping(start_time, end_time):
+            union = (max(end_time, label_end) - min(start_time, label_start)).total_seconds()
+            intersection = (min(end_time, label_end) - max(start_time, label_start)).total_seconds()
+            overlap = intersection / union if union > 0 else 1.0
+            if overlap >= min_overlap and (best is None or (overlap, -order) > best[:2]):
+                best = (overlap, -order, mode)
+
+        return [best[2]] if best is not None else []
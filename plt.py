@@ -0,0 +1,67 @@
+'''
+Reading of Geolife plt files straight from a memory map.
+
+A plt file has 6 header lines followed by one "lat,lon,0,altitude,date_days,YYYY-MM-DD,HH:MM:SS" line per point.
+Files with more than max_points points are excluded. A file too small to hold that many records is never
+counted, a larger one is counted exactly by finding its newlines in the mapped buffer. The fields of accepted
+files are matched in the buffer without reading the lines into a list first.
+'''
+
+from itertools import islice
+import mmap
+import os
+import re
+
+HEADER_LINES = 6
+MAX_POINTS = 2500
+
+# shortest possible record: single character numbers, a 10 character date, an 8 character time,
+# 6 commas and the newline
+MIN_RECORD_BYTES = 5 + 10 + 8 + 6 + 1
+
+NEWLINE = re.compile(b"\n")
+RECORD = re.compile(rb"^\s*([^,\n]*),([^,\n]*),[^,\n]*,([^,\n]*),([^,\n]*),([^,\n]*),([^,\s]*)[^\n]*$", re.MULTILINE)
+
+
+def may_exceed(size, max_points=MAX_POINTS):
+    '''
+    :param size: size of the file in bytes
+    :return: False when a file of this size cannot have more than max_points records
+    '''
+    # the header lines are at least a newline each and the last line may lack its newline
+    return size >= HEADER_LINES + MIN_RECORD_BYTES * (max_points + 1) - 1
+
+
+def line_end(buffer, lines):
+    '''
+    :return: offset after the newline ending the given number of lines, None if the buffer has fewer newlines
+    '''
+    if lines == 0:
+        return 0
+    newline = next(islice(NEWLINE.finditer(buffer), lines - 1, None), None)
+    return None if newline is None else newline.end()
+
+
+def read_records(file_path, max_points=MAX_POINTS):
+    '''
+    Read the records of a plt file
+    :param file_path: path of the plt file
+    :param max_points: files with more records than this are excluded
+    :return: list of (lat, lon, altitude, date_days, date, time) tuples of bytes, None if the file is excluded
+    '''
+    with open(file_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return []
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if may_exceed(size, max_points):
+                # more than max_points records when there is anything after the newline ending the last allowed one
+                end = line_end(buffer, HEADER_LINES + max_points)
+                if end is not None and end < size:
+                    return None
+
+            start = line_end(buffer, HEADER_LINES)
+            if start is None:
+                return []
+            return RECORD.findall(buffer, start)
@@ -1,33 +1,370 @@
+from DataUploader import INVALID_ALTITUDE, LAYOUT_BUCKETS, LAYOUT_DOCUMENTS, LAYOUT_TIMESERIES, LAYOUTS, \
+    META_COLLECTION, MODE_SUMMARY, SUMMARIES, TIMESERIES_OPTIONS, TRACKPOINT_COLLECTIONS, USER_MODE_SUMMARY, \
+    USER_SUMMARY, YEAR_SUMMARY
 from DbConnector import DbConnector
+from instrumentation import Instrumentation
+from QueryCache import QueryCache
+from trackpoints import GRID_COLUMNS, GRID_DEGREES, TIME_BUCKET_SECONDS, time_bucket, to_micros
 from pprint import pprint
-from datetime import datetime
-from haversine import haversine
+from pymongo import ReadPreference
+from datetime import datetime, timedelta
+import functools
+import heapq
+import math
+import sys
+
+# MongoDB measures spherical distances on a sphere with this radius
+EARTH_RADIUS_METRES = 6378100
+
+FORBIDDEN_CITY = (39.916, 116.397)
+FORBIDDEN_CITY_RADIUS = 50
+
+FEET_TO_METRES = 0.3048
+
+# ways q8 can compute the altitude gain per user, see Query.altitude_gain_ranking
+ALTITUDE_GAIN_ENGINES = ("activity", "window", "stream")
+
+
+def distance_metres(lat1, lon1, lat2, lon2):
+    '''
+    Great circle distance between two points on the sphere MongoDB uses for $centerSphere and $nearSphere
+    '''
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_METRES * math.asin(math.sqrt(min(1.0, a)))
+
+
+def cached(method):
+    '''
+    Decorator for Query methods whose result is stored in the query cache, if the Query has one.
+    Every call is timed as the span query.<method>
+    '''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.instrumentation.span("query." + method.__name__):
+            if self.cache is None:
+                return method(self, *args, **kwargs)
+            key = [self.layout, method.__name__, list(args), kwargs]
+            return self.cache.get(key, lambda: method(self, *args, **kwargs))
+    return wrapper
 
 
 class Query:
-    def __init__(self):
-        self.connection = DbConnector()
+    def __init__(self, layout=LAYOUT_DOCUMENTS, connection=None, cache=None, instrumentation=None, summaries=True):
+        '''
+        :param layout: how the trackpoints were stored by DataUploader, one of LAYOUTS
+        :param connection: DbConnector to use, by default a connector with the "query" profile
+        :param cache: QueryCache for the results of the qN methods, True for an in-memory cache, None for no cache
+        :param instrumentation: Instrumentation recording the qN methods and database commands, None to record nothing
+        :param summaries: answer q2-q6 and q11 from the summary collections of DataUploader when they are valid,
+            False to always aggregate the Activity collection
+        '''
+        if layout not in LAYOUTS:
+            raise ValueError("Unknown trackpoint layout: " + str(layout))
+
+        self.instrumentation = instrumentation or Instrumentation(enabled=False)
+        self.connection = connection or DbConnector(profile="query",
+                                                    event_listeners=self.instrumentation.event_listeners())
         self.client = self.connection.client
-        self.db = self.connection.db
+        self.layout = layout
+        self.summaries = summaries
+
+        # The summaries and their valid flag are read from the primary, a lagging secondary could still have the
+        # summaries from before an upload. Cached results are stored under the dataset version of the primary, so
+        # with a cache every read goes to the primary, else results of older data would be kept as current ones.
+        self.primary = self.connection.db.with_options(read_preference=ReadPreference.PRIMARY)
+        self.db = self.primary if cache is not None else self.connection.db
+        self.cache = QueryCache(self.db) if cache is True else cache
+
+    def use_summaries(self):
+        '''
+        :return: True when the summary collections are used and match the Activity collection
+        '''
+        if not self.summaries:
+            return False
+        state = self.primary[META_COLLECTION].find_one({"_id": SUMMARIES})
+        return state is not None and state.get("valid", False)
+
+    def trackpoint_field(self, name):
+        '''
+        :return: the path of user_id or activity_id in the trackpoint documents of the layout
+        '''
+        if self.layout == LAYOUT_TIMESERIES:
+            return TIMESERIES_OPTIONS["metaField"] + "." + name
+        return name
+
+    def trackpoint_owner(self, trackpoint, name):
+        '''
+        :return: the user_id or activity_id of a trackpoint document of the layout
+        '''
+        if self.layout == LAYOUT_TIMESERIES:
+            return trackpoint[TIMESERIES_OPTIONS["metaField"]][name]
+        return trackpoint[name]
+
+    def activity_trackpoints(self, activity_ids, fields):
+        '''
+        Read the trackpoints of some activities without joining them to the Activity collection
+        :param activity_ids: ids of the activities
+        :param fields: trackpoint fields to read
+        :return: dict from activity id to a dict from field to the list of values, ordered by date_time
+        '''
+        activity_ids = list(activity_ids)
+        result = {activity_id: {field: [] for field in fields} for activity_id in activity_ids}
+        projection = {field: 1 for field in fields}
+        projection[self.trackpoint_field("activity_id")] = 1
+
+        if self.layout == LAYOUT_BUCKETS:
+            buckets = self.db[TRACKPOINT_COLLECTIONS[LAYOUT_BUCKETS]].find(
+                {"activity_id": {"$in": activity_ids}}, projection).sort([("activity_id", 1), ("n", 1)])
+            for bucket in buckets:
+                points = result[bucket["activity_id"]]
+                for field in fields:
+                    points[field].extend(bucket[field])
+        else:
+            activity_field = self.trackpoint_field("activity_id")
+            trackpoints = self.db[TRACKPOINT_COLLECTIONS[self.layout]].find(
+                {activity_field: {"$in": activity_ids}}, projection).sort([(activity_field, 1), ("date_time", 1)])
+            for trackpoint in trackpoints:
+                points = result[self.trackpoint_owner(trackpoint, "activity_id")]
+                for field in fields:
+                    points[field].append(trackpoint[field])
+
+        return result
+
+    def _near_filter(self, lat, lon, radius, start_time, end_time):
+        if self.layout == LAYOUT_BUCKETS:
+            # bounding box of the circle, the points in the matching buckets are checked exactly
+            delta_lat = math.degrees(radius / EARTH_RADIUS_METRES)
+            delta_lon = delta_lat / max(math.cos(math.radians(lat)), 1e-12)
+            query = {
+                "min_lat": {"$lte": lat + delta_lat},
+                "max_lat": {"$gte": lat - delta_lat},
+                "min_lon": {"$lte": lon + delta_lon},
+                "max_lon": {"$gte": lon - delta_lon}
+            }
+            if start_time is not None:
+                query["end_date_time"] = {"$gte": start_time}
+            if end_time is not None:
+                query["start_date_time"] = {"$lte": end_time}
+            return query
+
+        query = {"location": {"$geoWithin": {"$centerSphere": [[lon, lat], radius / EARTH_RADIUS_METRES]}}}
+        if start_time is not None or end_time is not None:
+            query["date_time"] = {}
+            if start_time is not None:
+                query["date_time"]["$gte"] = start_time
+            if end_time is not None:
+                query["date_time"]["$lte"] = end_time
+        return query
+
+    def _buckets_near(self, lat, lon, radius, start_time, end_time):
+        '''
+        Find the buckets with at least one point within radius metres of a point in the time window
+        '''
+        buckets = self.db[TRACKPOINT_COLLECTIONS[LAYOUT_BUCKETS]].find(
+            self._near_filter(lat, lon, radius, start_time, end_time),
+            {"user_id": 1, "activity_id": 1, "lat": 1, "lon": 1, "date_time": 1})
+
+        for bucket in buckets:
+            for point_lat, point_lon, date_time in zip(bucket["lat"], bucket["lon"], bucket["date_time"]):
+                if (start_time is None or date_time >= start_time) and (end_time is None or date_time <= end_time) \
+                        and distance_metres(lat, lon, point_lat, point_lon) <= radius:
+                    yield bucket
+                    break
 
+    def users_near(self, lat, lon, radius, start_time=None, end_time=None):
+        '''
+        Find the users that have been within radius metres of a point
+        :param lat: latitude of the point
+        :param lon: longitude of the point
+        :param radius: distance in metres
+        :param start_time: only count trackpoints from this time, optional
+        :param end_time: only count trackpoints up to this time, optional
+        :return: sorted list of user ids
+        '''
+        if self.layout == LAYOUT_BUCKETS:
+            return sorted(set(bucket["user_id"] for bucket in self._buckets_near(lat, lon, radius, start_time, end_time)))
+
+        collection = self.db[TRACKPOINT_COLLECTIONS[self.layout]]
+        return sorted(collection.distinct(self.trackpoint_field("user_id"),
+                                          self._near_filter(lat, lon, radius, start_time, end_time)))
+
+    def activities_near(self, lat, lon, radius, start_time=None, end_time=None):
+        '''
+        Find the activities that have been within radius metres of a point, see users_near
+        :return: sorted list of activity ids
+        '''
+        if self.layout == LAYOUT_BUCKETS:
+            return sorted(set(bucket["activity_id"] for bucket in self._buckets_near(lat, lon, radius, start_time, end_time)))
+
+        collection = self.db[TRACKPOINT_COLLECTIONS[self.layout]]
+        return sorted(collection.distinct(self.trackpoint_field("activity_id"),
+                                          self._near_filter(lat, lon, radius, start_time, end_time)))
+
+    def trackpoints_nearest(self, lat, lon, radius, limit=100):
+        '''
+        Find the trackpoints closest to a point, nearest first
+        :param lat: latitude of the point
+        :param lon: longitude of the point
+        :param radius: maximum distance in metres
+        :param limit: maximum number of trackpoints
+        :return: list of trackpoint documents with user_id, activity_id, lat, lon and date_time
+        '''
+        if self.layout == LAYOUT_BUCKETS:
+            points = []
+            for bucket in self._buckets_near(lat, lon, radius, None, None):
+                for point_lat, point_lon, date_time in zip(bucket["lat"], bucket["lon"], bucket["date_time"]):
+                    distance = distance_metres(lat, lon, point_lat, point_lon)
+                    if distance <= radius:
+                        points.append((distance, {"user_id": bucket["user_id"], "activity_id": bucket["activity_id"],
+                                                  "lat": point_lat, "lon": point_lon, "date_time": date_time}))
+            points.sort(key=lambda point: point[0])
+            return [point for distance, point in points[:limit]]
+
+        if self.layout == LAYOUT_TIMESERIES:
+            # time-series collections do not support $nearSphere, only the $geoNear stage
+            trackpoints = self.db[TRACKPOINT_COLLECTIONS[LAYOUT_TIMESERIES]].aggregate([
+                {"$geoNear": {
+                    "near": {"type": "Point", "coordinates": [lon, lat]},
+                    "key": "location",
+                    "distanceField": "distance",
+                    "maxDistance": radius,
+                    "spherical": True
+                }},
+                {"$limit": limit},
+                {"$project": {"_id": 0, "user_id": "$meta.user_id", "activity_id": "$meta.activity_id",
+                              "lat": 1, "lon": 1, "date_time": 1}}
+            ])
+            return list(trackpoints)
+
+        collection = self.db[TRACKPOINT_COLLECTIONS[LAYOUT_DOCUMENTS]]
+        trackpoints = collection.find({"location": {"$nearSphere": {
+            "$geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "$maxDistance": radius
+        }}}, {"_id": 0, "user_id": 1, "activity_id": 1, "lat": 1, "lon": 1, "date_time": 1}).limit(limit)
+        return list(trackpoints)
+
+    def colocated_users(self, radius, minutes, start_time=None, end_time=None):
+        '''
+        Find the pairs of users that have been within radius metres of each other within the given minutes.
+        The trackpoints are read ordered by (time_bucket, cell) and every point is only compared with the points
+        of other users in the cells and time buckets close enough to hold a match, so the work grows with the
+        number of points near each other rather than with the square of the number of points
+        :param radius: distance in metres
+        :param minutes: maximum time between the two points
+        :param start_time: only use trackpoints from this time, optional
+        :param end_time: only use trackpoints up to this time, optional
+        :return: sorted list of (user_id, user_id) pairs, the smaller user id first
+        '''
+        if self.layout == LAYOUT_BUCKETS:
+            raise ValueError("The co-location query needs one document per trackpoint")
+
+        window = timedelta(minutes=minutes)
+        bucket_reach = math.ceil(window.total_seconds() / TIME_BUCKET_SECONDS)
+        # points within radius are at most this many radians apart in latitude
+        angle = radius / EARTH_RADIUS_METRES
+        row_reach = math.ceil(math.degrees(angle) / GRID_DEGREES)
+
+        query = {}
+        if start_time is not None or end_time is not None:
+            query["date_time"] = {}
+            query["time_bucket"] = {}
+            if start_time is not None:
+                query["date_time"]["$gte"] = start_time
+                query["time_bucket"]["$gte"] = time_bucket(to_micros(start_time))
+            if end_time is not None:
+                query["date_time"]["$lte"] = end_time
+                query["time_bucket"]["$lte"] = time_bucket(to_micros(end_time))
+
+        user_field = self.trackpoint_field("user_id")
+        points = self.db[TRACKPOINT_COLLECTIONS[self.layout]].find(
+            query, {"_id": 0, user_field: 1, "lat": 1, "lon": 1, "date_time": 1, "cell": 1, "time_bucket": 1}
+        ).sort([("time_bucket", 1), ("cell", 1)]).batch_size(10000)
+
+        pairs = set()
+        # time bucket -> cell -> user -> (lat, lon, date_time) of the points read so far, for the buckets in reach
+        buckets = {}
+        for point in points:
+            bucket = point["time_bucket"]
+            if bucket not in buckets:
+                for old in [old for old in buckets if old < bucket - bucket_reach]:
+                    del buckets[old]
+                buckets[bucket] = {}
+
+            user_id = self.trackpoint_owner(point, "user_id")
+            lat, lon, date_time = point["lat"], point["lon"], point["date_time"]
+            row, column = divmod(point["cell"], GRID_COLUMNS)
+            # and this many in longitude, at the latitude within reach closest to a pole
+            cos_lat = math.cos(math.radians(min(90.0, abs(lat) + (row_reach + 1) * GRID_DEGREES)))
+            column_reach = GRID_COLUMNS if cos_lat <= math.sin(angle / 2) else \
+                math.ceil(math.degrees(2 * math.asin(math.sin(angle / 2) / cos_lat)) / GRID_DEGREES)
+
+            for near_bucket in range(bucket - bucket_reach, bucket + 1):
+                cells = buckets.get(near_bucket)
+                if not cells:
+                    continue
+                if (2 * row_reach + 1) * (2 * column_reach + 1) > len(cells):
+                    # fewer cells have points than are in reach, e.g. for a radius of many cells
+                    near_cells = [users for cell, users in cells.items()
+                                  if abs(cell // GRID_COLUMNS - row) <= row_reach and
+                                  abs(cell % GRID_COLUMNS - column) <= column_reach]
+                else:
+                    near_cells = [cells[near_row * GRID_COLUMNS + near_column]
+                                  for near_row in range(row - row_reach, row + row_reach + 1)
+                                  for near_column in range(column - column_reach, column + column_reach + 1)
+                                  if near_row * GRID_COLUMNS + near_column in cells]
+
+                for users in near_cells:
+                    for other, other_points in users.items():
+                        pair = (user_id, other) if user_id < other else (other, user_id)
+                        if other == user_id or pair in pairs:
+                            continue
+                        for other_lat, other_lon, other_time in other_points:
+                            if abs(date_time - other_time) <= window and \
+                                    distance_metres(lat, lon, other_lat, other_lon) <= radius:
+                                pairs.add(pair)
+                                break
+
+            buckets[bucket].setdefault(point["cell"], {}).setdefault(user_id, []).append((lat, lon, date_time))
+
+        return sorted(pairs)
+
+    @cached
     def q1(self):
-        collections = ["TrackPoint", "Activity", "User"]
+        """Count the documents in each collection.
+        :return: dict from collection name to number of documents"""
+        collections = [TRACKPOINT_COLLECTIONS[self.layout], "Activity", "User"]
 
+        counts = {}
         for collection in collections:
             col = self.db[collection]
-            count = col.count()
-            print("Collections {collection} has {count} documents.")
-
-
+            if collection == TRACKPOINT_COLLECTIONS[LAYOUT_TIMESERIES]:
+                # a time-series collection is a view and has no count metadata
+                counts[collection] = col.count_documents({})
+            else:
+                counts[collection] = col.estimated_document_count()
+        return counts
+
+    @cached
     def q2(self):
-        activities = self.db["Activity"].count_documents({})
+        """Find the average number of activities per user.
+        :return: average rounded to whole activities"""
+        if self.use_summaries():
+            activities = sum(user["activities"] for user in self.primary[USER_SUMMARY].find({}, {"activities": 1}))
+        else:
+            activities = self.db["Activity"].count_documents({})
         users = self.db["User"].count_documents({})
         avg = activities / users
-        print("The average number of activities per user is: {}".format(round(avg, 0), float))
-
+        return round(avg, 0)
 
+    @cached
     def q3(self):
-        """Find the top 20 users with the highest number of activities."""
+        """Find the top 20 users with the highest number of activities.
+        :return: list of (user_id, number of activities)"""
+        if self.use_summaries():
+            users = self.primary[USER_SUMMARY].find().sort([("activities", -1), ("_id", 1)]).limit(20)
+            return [(user["_id"], user["activities"]) for user in users]
+
         activities = self.db["Activity"]
         top20_users = activities.aggregate([
             {"$group": {
@@ -39,17 +376,27 @@ class Query:
             {"$limit": 20}
 
         ])
-        print("Users with the most activities are:")
-        print("User  Activities")
+        return [(user["_id"], user["count"]) for user in top20_users]
+
+    @cached
+    def q4(self):
+        """Find the users that have taken a taxi.
+        :return: list of user ids"""
+        if self.use_summaries():
+            return sorted(self.primary[USER_MODE_SUMMARY].distinct("_id.user_id", {"_id.transportation_mode": "taxi"}))
 
-        for user in top20_users:
-            pprint(str(user["_id"]) + "  " + str(user["count"]))
-        def q4(self):
-            collection = self.db["Activity"]
-            user_ids = collection.distinct("user_id", {"transportation_mode": "taxi"})
-            print("The following users have taken a taxi:", user_ids)
+        collection = self.db["Activity"]
+        user_ids = collection.distinct("user_id", {"transportation_mode": "taxi"})
+        return sorted(user_ids)
 
+    @cached
     def q5(self):
+        """Count the activities per transportation mode.
+        :return: dict from transportation mode to number of activities"""
+        if self.use_summaries():
+            modes = self.primary[MODE_SUMMARY].find({"_id": {"$ne": "null"}})
+            return {mode["_id"]: mode["activities"] for mode in modes}
+
         collection = self.db["Activity"]
         types = collection.aggregate([
             {
@@ -68,13 +415,19 @@ class Query:
                 }
             }
         ])
-        print("Activities per transport mode:")
-        for data in list(types):
-            print(" - {}: {}".format(data["_id"], data["count"]))
+        return {data["_id"]: data["count"] for data in types}
 
+    @cached
     def q6(self):
         """a) Find the year with the most activities.
-           b) Is this also the year with most recorded hours?"""
+           b) Is this also the year with most recorded hours?
+        :return: (year with most activities, year with most hours)"""
+        if self.use_summaries():
+            years = self.primary[YEAR_SUMMARY]
+            most_activities = next(years.find().sort("activities", -1).limit(1), {}).get("_id")
+            most_hours = next(years.find().sort("duration", -1).limit(1), {}).get("_id")
+            return most_activities, most_hours
+
         activities = self.db["Activity"]
         #a
         activities_per_year = activities.aggregate([
@@ -87,8 +440,9 @@ class Query:
             }},
             {"$limit": 1}
         ])
+        most_activities = None
         for year in activities_per_year:
-            print("The year with the most activities was: " + str(year["_id"]))
+            most_activities = year["_id"]
 
         #b
         hours_per_year = activities.aggregate([
@@ -97,13 +451,20 @@ class Query:
                 "Hours" : {"$sum": {"$subtract":["$end_date_time", "$start_date_time"]} }
             }},
             {"$sort": {
-                "Activities": -1
+                "Hours": -1
             }},
             {"$limit": 1}
         ])
+        most_hours = None
         for year in hours_per_year:
-            print("The year with the most hours was: " + str(year["_id"]))
+            most_hours = year["_id"]
+
+        return most_activities, most_hours
+
+    @cached
     def q7(self):
+        """Find the total distance walked in 2008 by user 112.
+        :return: distance in km"""
         activity_col = self.db["Activity"]
         activities = activity_col.aggregate([
             {"$match": {
@@ -112,154 +473,156 @@ class Query:
                 "start_date_time": {"$gte": datetime(year=2008, month=1, day=1)},
                 "end_date_time": {"$lt": datetime(year=2009, month=1, day=1)}
             }},
-            {"$lookup": {
-                "from": "TrackPoint", "localField": "_id", "foreignField": "activity_id", "as": "trackpoints"
-            }},
-            {"$project": {
-                "trackpoints.lat": 1,
-                "trackpoints.lon": 1
+            {"$group": {
+                "_id": None, "total_dist": {"$sum": "$distance"}
             }}
         ])
 
         total_dist = 0
         for activity in activities:
-            trackpoints = activity["trackpoints"]
-            for i in range(len(trackpoints) - 1):
-                coord1 = (float(trackpoints[i]["lat"]), float(trackpoints[i]["lon"]))
-                coord2 = (float(trackpoints[i + 1]["lat"]), float(trackpoints[i + 1]["lon"]))
-                dist = haversine(coord1, coord2)
-                total_dist += dist
-
-        print("Total distance walked by user 112: {total_dist}")
-
-    def q8(self):
-        collection = self.db["TrackPoint"]
-        meters = collection.aggregate([
-            {
-                "$match": {
-                    "user_id": {
-                        "$exists": True,
-                        "$ne": "null",
-                    },
-                    "altitude": {
-                        "$exists": True,
-                        "$ne": "null",
-                    }
-                }
-            },
-            {
-                "$addFields": {
-                    "prevTPID": {"$subtract": ["$_id", 1]}
-                }
-            },
-            {
-                "$sort": {
-                    "_id": -1,
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "TrackPoint",
-                    "localField": "prevTPID",
-                    "foreignField": "_id",
-                    "as": "t2"
-                }
-            },
-            {
-                "$project": {
-                    "user_id": 1,
-                    "delta": {"$subtract": ["$altitude", {"$sum": "$t2.altitude"}]}
-                }
-            },
-            {
-                "$group": {
-                    "_id": '$user_id',
-                    "total": {
-                        "$sum": {
-                            "$cond": [
-                                {"$gt": ['$delta', 0]}, '$delta', 0
-                            ]
-                        }
-                    }
-                }
-            },
-            {
-                "$sort": {"total": -1}
-            },
-            {
-                "$limit": 20
-            }
-        ], allowDiskUse=True)
-        print("Top 20 users that gained most altitude:")
-        for data in list(meters):
-            print(" {}: {}".format(data["_id"], float(data["total"]) * 0.3048))
-
-            
+            total_dist = activity["total_dist"]
+
+        return total_dist
+
+    def iter_trackpoints(self, fields):
+        '''
+        Stream all trackpoints ordered by (activity_id, date_time), holding one point or bucket at a time
+        :param fields: trackpoint fields to read besides user_id and activity_id
+        :return: generator of dicts with user_id, activity_id and the fields
+        '''
+        projection = {field: 1 for field in fields}
+        projection[self.trackpoint_field("user_id")] = 1
+        projection[self.trackpoint_field("activity_id")] = 1
+
+        if self.layout == LAYOUT_BUCKETS:
+            buckets = self.db[TRACKPOINT_COLLECTIONS[LAYOUT_BUCKETS]].find({}, projection).sort(
+                [("activity_id", 1), ("n", 1)])
+            for bucket in buckets:
+                for values in zip(*(bucket[field] for field in fields)):
+                    trackpoint = dict(zip(fields, values))
+                    trackpoint["user_id"] = bucket["user_id"]
+                    trackpoint["activity_id"] = bucket["activity_id"]
+                    yield trackpoint
+            return
+
+        trackpoints = self.db[TRACKPOINT_COLLECTIONS[self.layout]].find({}, projection).sort(
+            [(self.trackpoint_field("activity_id"), 1), ("date_time", 1)]).batch_size(10000)
+        for trackpoint in trackpoints:
+            if self.layout == LAYOUT_TIMESERIES:
+                trackpoint.update(trackpoint.pop(TIMESERIES_OPTIONS["metaField"]))
+            yield trackpoint
+
+    def altitude_gain_ranking(self, engine="activity", limit=20):
+        '''
+        Rank the users by the altitude they gained, summing the rises between consecutive valid altitudes of each activity
+        :param engine: "activity" sums the altitude_gain stored on each activity at ingest,
+            "window" computes the rises on the server with $setWindowFields (MongoDB 5.0 or newer),
+            "stream" computes them in one pass over the trackpoints sorted by (activity_id, date_time)
+        :param limit: number of users
+        :return: list of (user_id, altitude gain in feet), highest first
+        '''
+        if engine == "activity":
+            totals = self.db["Activity"].aggregate([
+                {"$group": {"_id": "$user_id", "total": {"$sum": "$altitude_gain"}}},
+                {"$sort": {"total": -1}},
+                {"$limit": limit}
+            ])
+            return [(data["_id"], data["total"]) for data in totals]
+
+        if engine == "window":
+            if self.layout == LAYOUT_BUCKETS:
+                raise ValueError("The window engine needs one document per trackpoint")
+            totals = self.db[TRACKPOINT_COLLECTIONS[self.layout]].aggregate([
+                {"$match": {"altitude": {"$ne": INVALID_ALTITUDE}}},
+                {"$setWindowFields": {
+                    "partitionBy": "$" + self.trackpoint_field("activity_id"),
+                    "sortBy": {"date_time": 1},
+                    "output": {"previous": {"$shift": {"output": "$altitude", "by": -1}}}
+                }},
+                {"$group": {
+                    "_id": "$" + self.trackpoint_field("user_id"),
+                    "total": {"$sum": {"$cond": [
+                        {"$and": [{"$ne": ["$previous", None]}, {"$gt": ["$altitude", "$previous"]}]},
+                        {"$subtract": ["$altitude", "$previous"]},
+                        0
+                    ]}}
+                }},
+                {"$sort": {"total": -1}},
+                {"$limit": limit}
+            ], allowDiskUse=True)
+            return [(data["_id"], data["total"]) for data in totals]
+
+        if engine == "stream":
+            totals = {}
+            previous_activity = None
+            previous_altitude = None
+            for trackpoint in self.iter_trackpoints(["altitude"]):
+                if trackpoint["activity_id"] != previous_activity:
+                    previous_activity = trackpoint["activity_id"]
+                    previous_altitude = None
+                    totals.setdefault(trackpoint["user_id"], 0)
+
+                altitude = trackpoint["altitude"]
+                if altitude == INVALID_ALTITUDE:
+                    continue
+                if previous_altitude is not None and altitude > previous_altitude:
+                    totals[trackpoint["user_id"]] += altitude - previous_altitude
+                previous_altitude = altitude
+
+            return heapq.nlargest(limit, totals.items(), key=lambda total: total[1])
+
+        raise ValueError("Unknown altitude gain engine: " + str(engine))
+
+    @cached
+    def q8(self, engine="activity"):
+        """Find the top 20 users that gained the most altitude.
+        :param engine: see altitude_gain_ranking
+        :return: list of (user_id, altitude gain in metres)"""
+        return [(user_id, float(total) * FEET_TO_METRES) for user_id, total in self.altitude_gain_ranking(engine, 20)]
+
+    @cached
     def q9(self):
         """Find all users who have invalid activities, and the number of invalid activities per
         user
         An invalid activity is defined as an activity with consecutive trackpoints
-        where the timestamps deviate with at least 5 minutes."""
+        where the timestamps deviate with at least 5 minutes.
+        :return: dict from user id to number of invalid activities"""
         collection = self.db["Activity"]
-        activity_trackpoints = collection.aggregate([
-            {"$lookup": {
-                "from": "TrackPoint",
-                "localField" : "_id",
-                "foreignField" : "activity_id",
-                "as" : "Activity"
-            }},
-            {"$project": {
-                "user_id" : "$user_id", "Activity" : "$Activity.activity_id" , "Time" : "$Activity.date_time"
-            }},
-            {"$limit" : 100}
-
-        ])
-
-        activity_trackpoints = list(activity_trackpoints)
-
-        previous_time = datetime.now()
-        previous_activity = 0
-        invalid_trackpoints = {}
-
-        for activity in activity_trackpoints:
-            current_activity = activity["Activity"]
-
-            for time in activity["Time"]:
-                current_time = time
-
-                if (current_activity == previous_activity) and (current_time - previous_time).total_seconds() > 5*60 :
-                    if activity["user_id"] not in invalid_trackpoints.keys():
-                        invalid_trackpoints[activity["user_id"]] = 1
-                    else:
-                        invalid_trackpoints[activity["user_id"]] += 1
-                    break
-                previous_time = current_time
-                previous_activity = current_activity
-
-        for user,value in invalid_trackpoints.items():
-            print(user, value)
-
-
-    def q10(self):
-        lat = 39.916
-        lon = 116.397
-        collection = self.db["TrackPoint"]
-        user_ids = collection.aggregate([
+        invalid_activities = collection.aggregate([
             {"$match": {
-                "lat": {"$lt": lat + 0.0005, "$gte": lat - 0.0005},
-                "lon": {"$lt": lon + 0.0005, "$gte": lon - 0.0005}
+                "max_time_gap": {"$gt": 5*60}
             }},
             {"$group": {
-                "_id": "$user_id",
+                "_id": "$user_id", "count": {"$sum": 1}
+            }},
+            {"$sort": {
+                "_id": 1
             }}
         ])
 
-        print("The following users have been in the Forbidden City:")
-        for data in user_ids:
-            pprint(data["_id"])
+        return {data["_id"]: data["count"] for data in invalid_activities}
 
+    @cached
+    def q10(self):
+        """Find the users that have been in the Forbidden City.
+        :return: list of user ids"""
+        lat, lon = FORBIDDEN_CITY
+        return self.users_near(lat, lon, FORBIDDEN_CITY_RADIUS)
 
+    @cached
     def q11(self):
+        """Find the most used transportation mode of every user that has labeled activities.
+        :return: list of dicts with user_id and most_used_transportation_mode"""
+        if self.use_summaries():
+            data = self.primary[USER_MODE_SUMMARY].aggregate([
+                {"$match": {"_id.transportation_mode": {"$ne": "null"}}},
+                {"$sort": {"activities": -1, "_id.transportation_mode": -1}},
+                {"$group": {"_id": "$_id.user_id", "category": {"$first": "$_id.transportation_mode"}}},
+                {"$project": {"_id": 0, "user_id": "$_id", "most_used_transportation_mode": "$category"}},
+                {"$sort": {"user_id": 1}}
+            ])
+            return list(data)
+
         collection = self.db["Activity"]
         data = collection.aggregate([
             {
@@ -312,10 +675,14 @@ class Query:
                 }
             }
         ])
-        print("Most common transportation mode for users (only users who have registered the transportation_mode)")
-        print(list(data))
+        return list(data)
+
 
-q = Query()
-q.q8()
+if __name__ == '__main__':
+    q = Query()
+    for name in sys.argv[1:] or ["q8"]:
+        print(name + ":")
+        pprint(getattr(q, name)())
+    q.connection.close_connection()
 
 
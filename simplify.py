@@ -0,0 +1,108 @@
+'''
+Trajectory simplification with the Douglas-Peucker algorithm.
+
+A trajectory is simplified by keeping its first and last point and, recursively, the point furthest from the
+segment between the kept points around it as long as that point is further away than the tolerance. Every
+dropped point is then within the tolerance of the simplified trajectory.
+
+The points are projected onto a plane in metres around the first point, which is accurate to well under a
+metre over the extent of one plt file. The "spatial" mode measures the distance from a point to the segment,
+the "time" mode measures it to where the segment places the object at the time of the point when it moves at
+constant speed (the synchronized Euclidean distance), so that stops and changes of speed are kept as well.
+'''
+
+import math
+
+SIMPLIFY_MODES = ("spatial", "time")
+
+# mean radius of the earth, as used by haversine
+EARTH_RADIUS_METRES = 6371008.8
+
+
+def project(lat, lon):
+    '''
+    Equirectangular projection around the first point
+    :return: x and y in metres, as two lists
+    '''
+    if len(lat) == 0:
+        return [], []
+    scale = math.radians(EARTH_RADIUS_METRES)
+    x_scale = scale * math.cos(math.radians(lat[0]))
+    return [(value - lon[0]) * x_scale for value in lon], [(value - lat[0]) * scale for value in lat]
+
+
+def segment_distance(x, y, x1, y1, x2, y2):
+    '''
+    Distance from (x, y) to the segment from (x1, y1) to (x2, y2)
+    '''
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    fraction = 0.0 if length == 0 else min(1.0, max(0.0, ((x - x1) * dx + (y - y1) * dy) / length))
+    return math.hypot(x - x1 - fraction * dx, y - y1 - fraction * dy)
+
+
+def synchronized_distance(x, y, t, x1, y1, t1, x2, y2, t2):
+    '''
+    Distance from (x, y) to the position on the segment at time t, moving at constant speed from t1 to t2
+    '''
+    fraction = 0.0 if t2 == t1 else min(1.0, max(0.0, (t - t1) / (t2 - t1)))
+    return math.hypot(x - x1 - fraction * (x2 - x1), y - y1 - fraction * (y2 - y1))
+
+
+def douglas_peucker(lat, lon, times, tolerance, mode="spatial"):
+    '''
+    :param lat: latitudes of the points in recorded order
+    :param lon: longitudes of the points
+    :param times: times of the points in any unit, only used by the "time" mode
+    :param tolerance: maximum distance in metres of a dropped point from the simplified trajectory
+    :param mode: one of SIMPLIFY_MODES
+    :return: sorted list of the positions of the points to keep
+    '''
+    if mode not in SIMPLIFY_MODES:
+        raise ValueError("Unknown simplification mode: " + str(mode))
+
+    count = len(lat)
+    if count <= 2:
+        return list(range(count))
+
+    xs, ys = project(lat, lon)
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+
+    # ranges between kept points still to check, without recursion since a plt file can have thousands of points
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        x1, y1, x2, y2 = xs[first], ys[first], xs[last], ys[last]
+        furthest = None
+        furthest_distance = tolerance
+        for i in range(first + 1, last):
+            if mode == "time":
+                distance = synchronized_distance(xs[i], ys[i], times[i], x1, y1, times[first], x2, y2, times[last])
+            else:
+                distance = segment_distance(xs[i], ys[i], x1, y1, x2, y2)
+            if distance > furthest_distance:
+                furthest = i
+                furthest_distance = distance
+
+        if furthest is not None:
+            keep[furthest] = True
+            stack.append((first, furthest))
+            stack.append((furthest, last))
+
+    return [i for i in range(count) if keep[i]]
+
+
+def simplify(trackpoints, tolerance, mode="spatial"):
+    '''
+    Drop the points of one trajectory that are within the tolerance of the simplified trajectory
+    :param trackpoints: TrackPointColumns of one activity in recorded order
+    :param tolerance: distance in metres, see douglas_peucker
+    :param mode: one of SIMPLIFY_MODES
+    :return: TrackPointColumns with the kept points, starting at the same first_id
+    '''
+    return trackpoints.select(douglas_peucker(trackpoints.lat, trackpoints.lon, trackpoints.times, tolerance, mode))
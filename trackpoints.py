@@ -0,0 +1,256 @@
+'''
+Compact in-memory form of parsed trackpoints.
+
+A dict per GPS point costs about 700 bytes once its floats, datetime and GeoJSON location are counted.
+TrackPointColumns keeps the points of one plt file in typed array columns instead (about 40 bytes per point),
+the _id of the points is the consecutive range from first_id and they all have the same activity and user.
+The documents stored in the database are only built when they are written, see TrackPointColumns.documents.
+
+All trackpoint documents have the same fields, so TrackPointColumns.raw_documents packs their BSON directly
+with one struct per document and hands it to pymongo as RawBSONDocument, which is sent without re-encoding.
+The bytes are the same as bson.encode gives for the dict from TrackPointColumns.documents.
+
+Every point also gets the cell of a fixed grid of GRID_DEGREES and a time bucket of TIME_BUCKET_SECONDS, so that
+points near each other in space and time can be found through an index on (time_bucket, cell), see
+Query.colocated_users. The cell is row * GRID_COLUMNS + column, counting rows from the south pole and columns
+from the antimeridian, and is always stored as a 64 bit integer.
+'''
+
+from array import array
+from bson.int64 import Int64
+from bson.raw_bson import RawBSONDocument
+from datetime import datetime, timedelta
+import math
+import struct
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+# BSON element types
+BSON_DOUBLE = 0x01
+BSON_STRING = 0x02
+BSON_DOCUMENT = 0x03
+BSON_ARRAY = 0x04
+BSON_DATETIME = 0x09
+BSON_INT32 = 0x10
+BSON_INT64 = 0x12
+
+INT32_MIN = -2 ** 31
+INT32_MAX = 2 ** 31 - 1
+
+# about 111 m north to south, 85 m east to west in Beijing
+GRID_DEGREES = 0.001
+GRID_COLUMNS = round(360 / GRID_DEGREES)
+TIME_BUCKET_SECONDS = 300
+
+
+def to_micros(date_time):
+    '''
+    :return: microseconds between EPOCH and a naive datetime
+    '''
+    return (date_time - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    '''
+    :return: naive datetime of microseconds since EPOCH
+    '''
+    return EPOCH + timedelta(microseconds=micros)
+
+
+def grid_cell(lat, lon):
+    '''
+    :return: the id of the grid cell of a point
+    '''
+    return math.floor((lat + 90) / GRID_DEGREES) * GRID_COLUMNS + math.floor((lon + 180) / GRID_DEGREES)
+
+
+def time_bucket(micros):
+    '''
+    :param micros: time as microseconds since EPOCH
+    :return: number of the time bucket of the time
+    '''
+    return micros // (TIME_BUCKET_SECONDS * 1000000)
+
+
+def bson_key(element_type, name):
+    return bytes([element_type]) + name.encode() + b"\x00"
+
+
+def bson_int_type(value):
+    '''
+    :return: the BSON type bson.encode uses for a python int
+    '''
+    return BSON_INT32 if INT32_MIN <= value <= INT32_MAX else BSON_INT64
+
+
+class TrackPointEncoder:
+    '''
+    Packs the BSON of trackpoint documents of one user with a single struct, see TrackPointColumns.raw_documents
+    '''
+
+    def __init__(self, user_id, id_type, activity_id_type, meta=False):
+        '''
+        :param user_id: user of the points
+        :param id_type: BSON_INT32 or BSON_INT64 for the _id
+        :param activity_id_type: BSON_INT32 or BSON_INT64 for the activity_id
+        :param meta: put user_id and activity_id in a meta document, see TrackPointColumns.documents
+        '''
+        user_id = user_id.encode()
+        user_element = bson_key(BSON_STRING, "user_id") + struct.pack("<i", len(user_id) + 1) + user_id + b"\x00"
+        activity_key = bson_key(activity_id_type, "activity_id")
+        activity_code = "i" if activity_id_type == BSON_INT32 else "q"
+        point_type = bson_key(BSON_STRING, "type") + struct.pack("<i", 6) + b"Point\x00"
+        coordinates_size = 4 + len(bson_key(BSON_DOUBLE, "0")) + 8 + len(bson_key(BSON_DOUBLE, "1")) + 8 + 1
+        location_size = 4 + len(point_type) + len(bson_key(BSON_ARRAY, "coordinates")) + coordinates_size + 1
+
+        # the document as constant bytes and struct codes for the values in between,
+        # user_id and activity_id are the owner of the point
+        if meta:
+            meta_size = 4 + len(user_element) + len(activity_key) + struct.calcsize("<" + activity_code) + 1
+            owner = [
+                bson_key(BSON_DOCUMENT, "meta") + struct.pack("<i", meta_size) + user_element + activity_key,
+                activity_code,
+                b"\x00" + bson_key(BSON_DOUBLE, "lat")
+            ]
+        else:
+            owner = [activity_key, activity_code, user_element + bson_key(BSON_DOUBLE, "lat")]
+        parts = [
+            "i",
+            bson_key(id_type, "_id"), "i" if id_type == BSON_INT32 else "q",
+            *owner, "d",
+            bson_key(BSON_DOUBLE, "lon"), "d",
+            bson_key(BSON_DOCUMENT, "location") + struct.pack("<i", location_size) + point_type +
+            bson_key(BSON_ARRAY, "coordinates") + struct.pack("<i", coordinates_size) + bson_key(BSON_DOUBLE, "0"), "d",
+            bson_key(BSON_DOUBLE, "1"), "d",
+            b"\x00\x00" + bson_key(BSON_DOUBLE, "altitude"), "d",
+            bson_key(BSON_DOUBLE, "date_days"), "d",
+            bson_key(BSON_DATETIME, "date_time"), "q",
+            bson_key(BSON_INT64, "cell"), "q",
+            bson_key(BSON_INT32, "time_bucket"), "i",
+            b"\x00"
+        ]
+
+        # the constant bytes are packed as "s" fields
+        self.struct = struct.Struct("<" + "".join(part if isinstance(part, str) else "%ds" % len(part)
+                                                  for part in parts))
+        self.constants = [part for part in parts if not isinstance(part, str)]
+
+    def encode(self, _id, activity_id, lat, lon, altitude, date_days, millis, cell, bucket):
+        '''
+        :param millis: date_time as milliseconds since EPOCH
+        :param cell: grid_cell of the point
+        :param bucket: time_bucket of the point
+        :return: BSON of one trackpoint document
+        '''
+        c = self.constants
+        return self.struct.pack(self.struct.size, c[0], _id, c[1], activity_id, c[2], lat, c[3], lon, c[4], lon,
+                                c[5], lat, c[6], altitude, c[7], date_days, c[8], millis, c[9], cell, c[10], bucket,
+                                c[11])
+
+
+class TrackPointColumns:
+
+    __slots__ = ("user_id", "activity_id", "first_id", "lat", "lon", "altitude", "date_days", "times")
+
+    def __init__(self, user_id=None, activity_id=None, first_id=1):
+        '''
+        :param user_id: user of the points
+        :param activity_id: activity of the points
+        :param first_id: _id of the first point
+        '''
+        self.user_id = user_id
+        self.activity_id = activity_id
+        self.first_id = first_id
+        self.lat = array('d')
+        self.lon = array('d')
+        self.altitude = array('d')
+        self.date_days = array('d')
+        # date_time as microseconds since EPOCH
+        self.times = array('q')
+
+    def __len__(self):
+        return len(self.times)
+
+    def extend(self, lat, lon, altitude, date_days, date_times):
+        '''
+        Add points, given as one sequence per column
+        '''
+        self.lat.extend(lat)
+        self.lon.extend(lon)
+        self.altitude.extend(altitude)
+        self.date_days.extend(date_days)
+        self.times.extend(map(to_micros, date_times))
+
+    def select(self, indices):
+        '''
+        :param indices: positions of the points to keep, in order
+        :return: new TrackPointColumns with only these points, starting at the same first_id
+        '''
+        columns = TrackPointColumns(self.user_id, self.activity_id, self.first_id)
+        for name in ("lat", "lon", "altitude", "date_days", "times"):
+            values = getattr(self, name)
+            getattr(columns, name).extend(values[i] for i in indices)
+        return columns
+
+    @property
+    def ids(self):
+        return range(self.first_id, self.first_id + len(self))
+
+    def date_times(self, start=0, stop=None):
+        '''
+        :return: list of the datetimes of the points from start to stop
+        '''
+        return [from_micros(micros) for micros in self.times[start:stop]]
+
+    def documents(self, meta=False):
+        '''
+        Build the trackpoint documents one at a time, in the form stored in the TrackPoint collection
+        :param meta: put user_id and activity_id in a "meta" document instead, for a time-series collection
+        :return: generator of documents ordered by _id
+        '''
+        user_id = self.user_id
+        activity_id = self.activity_id
+        for _id, lat, lon, altitude, date_days, micros in zip(self.ids, self.lat, self.lon, self.altitude,
+                                                              self.date_days, self.times):
+            document = {"_id": _id}
+            if meta:
+                document["meta"] = {"user_id": user_id, "activity_id": activity_id}
+            else:
+                document["activity_id"] = activity_id
+                document["user_id"] = user_id
+            document.update({
+                "lat": lat,
+                "lon": lon,
+                "location": {"type": "Point", "coordinates": [lon, lat]},
+                "altitude": altitude,
+                "date_days": date_days,
+                "date_time": from_micros(micros),
+                "cell": Int64(grid_cell(lat, lon)),
+                "time_bucket": time_bucket(micros)
+            })
+            yield document
+
+    def raw_documents(self, meta=False):
+        '''
+        Encode the trackpoint documents directly into BSON
+        :param meta: see documents
+        :return: generator of RawBSONDocument ordered by _id, with the same bytes as bson.encode of documents(meta)
+        '''
+        activity_type = bson_int_type(self.activity_id)
+        encoders = {}
+        for _id, lat, lon, altitude, date_days, micros in zip(self.ids, self.lat, self.lon, self.altitude,
+                                                              self.date_days, self.times):
+            id_type = bson_int_type(_id)
+            encoder = encoders.get(id_type)
+            if encoder is None:
+                encoder = encoders[id_type] = TrackPointEncoder(self.user_id, id_type, activity_type, meta)
+            yield RawBSONDocument(encoder.encode(_id, self.activity_id, lat, lon, altitude, date_days,
+                                                 micros // 1000, grid_cell(lat, lon), time_bucket(micros)))
+
+    def nbytes(self):
+        '''
+        :return: size of the columns in bytes
+        '''
+        return sum(column.itemsize * len(column)
+                   for column in (self.lat, self.lon, self.altitude, self.date_days, self.times))